@@ -16,6 +16,12 @@ TEMPLATES_AUTO_RELOAD = True
 PLACE_MIN_AREA = 1      # km^2
 PLACE_MAX_AREA = 90000  # km^2
 
+MATCHER_WORKERS = 1  # processes used to run the matcher
+# load OSM objects into memory for the candidate search, needs shapely
+MATCHER_SPATIAL_INDEX = False
+# on refresh skip items where nothing the matcher uses has changed
+MATCHER_INCREMENTAL = False
+
 DB_NAME = '{{ db_name }}'
 DB_USER = '{{ db_user }}'
 DB_PASS = '{{ db_pass }}'
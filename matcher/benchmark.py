@@ -0,0 +1,183 @@
+'''Replay recorded matcher inputs through the hot path and time it.
+
+A recording is a JSON lines file, one item per line: the entity, tags,
+categories, extract, extract names, location, IsA items and place addresses
+of the item plus the OSM rows the candidate search returned for it.  Record once from a place that has been
+loaded into a local PostGIS, then replay as often as needed without touching
+the network.'''
+
+from . import match, matcher, wikidata
+from .model import Item, IsA
+from .place import Place, PlaceItem
+from .database import session
+from sqlalchemy.orm import contains_eager
+from time import perf_counter
+import json
+import math
+
+benchmarks = ['names_from_entity', 'categories_to_tags', 'name_match',
+              'check_for_match', 'find_item_matches']
+
+class ReplayCursor:
+    '''Stands in for the database when find_item_matches is given rows.'''
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return []
+
+def record_item(item, rows):
+    return {
+        'qid': item.qid,
+        'entity': item.entity,
+        'tags': sorted(item.tags),
+        'categories': item.categories or [],
+        'extract': item.extract,
+        'extract_names': item.extract_names or [],
+        'ewkt': item.ewkt,
+        'isa': [{'item_id': isa.item_id, 'label': isa.label, 'entity': isa.entity}
+                for isa in item.isa],
+        'places': [{'place_id': place.place_id, 'address': place.address}
+                   for place in item.places],
+        'rows': [list(row) for row in rows],
+    }
+
+def record(place, filename, limit=None):
+    ''' write the matcher inputs for a place to a recording
+
+    Every item with an entity is recorded, matched already or not.'''
+    place_items = (PlaceItem.query
+                            .join(Item)
+                            .filter(Item.entity.isnot(None),
+                                    PlaceItem.place == place)
+                            .options(contains_eager(PlaceItem.item)
+                                     .undefer(Item.entity)
+                                     .undefer(Item.ewkt))
+                            .order_by(PlaceItem.item_id)
+                            .limit(limit))
+    items = [pi.item for pi in place_items
+             if not pi.item.skip_item_during_match()]
+
+    conn = session.bind.raw_connection()
+    cur = conn.cursor()
+    found = matcher.find_batch_rows(cur, items, place.prefix)
+    conn.close()
+
+    with open(filename, 'w') as out:
+        for item in items:
+            rows = found.get(item.item_id, [])
+            print(json.dumps(record_item(item, rows)), file=out)
+    return len(items)
+
+def load(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def build_item(case):
+    item = Item(item_id=int(case['qid'][1:]),
+                entity=case['entity'],
+                tags=case['tags'],
+                categories=case['categories'],
+                extract_names=case['extract_names'],
+                ewkt=case['ewkt'],
+                isa=[IsA(**isa) for isa in case.get('isa', [])])
+    for place in case.get('places', []):
+        item.places.append(Place(**place))
+    if case.get('extract'):
+        item.extract = case['extract']
+    return item
+
+def percentile(values, pct):
+    '''nearest-rank percentile of an already sorted list'''
+    if not values:
+        return 0
+    rank = max(math.ceil(pct / 100 * len(values)), 1)
+    return values[rank - 1]
+
+def time_calls(func, args_list, repeat=3):
+    samples = []
+    start = perf_counter()
+    for _ in range(repeat):
+        for args in args_list:
+            t0 = perf_counter()
+            func(*args)
+            samples.append(perf_counter() - t0)
+    total = perf_counter() - start
+
+    samples.sort()
+    return {
+        'calls': len(samples),
+        'seconds': total,
+        'per_second': len(samples) / total if total else 0,
+        'p50': percentile(samples, 50),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'max': samples[-1] if samples else 0,
+    }
+
+def name_pairs(cases):
+    for case in cases:
+        wikidata_names = wikidata.names_from_entity(case['entity']) or {}
+        for src_type, src_id, osm_name, osm_tags, dist in case['rows']:
+            for osm in match.get_names(osm_tags).values():
+                for wd in wikidata_names:
+                    yield (osm, wd)
+
+def tag_checks(cases, items):
+    for case, item in zip(cases, items):
+        wikidata_names = wikidata.names_from_entity(case['entity'])
+        if not wikidata_names:
+            continue
+        endings = matcher.get_ending_from_criteria(case['tags'])
+        endings |= item.more_endings_from_isa()
+        for src_type, src_id, osm_name, osm_tags, dist in case['rows']:
+            yield (osm_tags, wikidata_names, endings)
+
+def run(cases, repeat=3, prefix='osm', cur=None, only=None):
+    ''' time each stage, returns {benchmark: result}
+
+    Without a cursor find_item_matches replays the recorded rows, with one it
+    runs the candidate search against the tables for prefix. '''
+    classifier = matcher.get_category_classifier()
+    items = [build_item(case) for case in cases]
+
+    def find_item_matches(item, rows):
+        if cur:
+            return matcher.find_item_matches(cur, item, prefix)
+        return matcher.find_item_matches(ReplayCursor(), item, prefix, rows=rows)
+
+    inputs = {
+        'names_from_entity': (wikidata.names_from_entity,
+                              [(case['entity'],) for case in cases]),
+        'categories_to_tags': (matcher.categories_to_tags,
+                               [(case['categories'], classifier) for case in cases]),
+        'name_match': (match.name_match, list(name_pairs(cases))),
+        'check_for_match': (match.check_for_match, list(tag_checks(cases, items))),
+        'find_item_matches': (find_item_matches,
+                              [(item, [tuple(row) for row in case['rows']])
+                               for item, case in zip(items, cases)]),
+    }
+
+    results = {}
+    for name in benchmarks:
+        if only and name not in only:
+            continue
+        func, args_list = inputs[name]
+        match.clear_name_forms()
+        matcher.match_profiles.clear()
+        results[name] = time_calls(func, args_list, repeat=repeat)
+    return results
+
+def compare(results, previous):
+    '''percentage change in p50 and throughput against an earlier run'''
+    changes = {}
+    for name, result in results.items():
+        before = previous.get(name)
+        if not before or not before['p50'] or not before['per_second']:
+            continue
+        changes[name] = {
+            'p50': (result['p50'] / before['p50'] - 1) * 100,
+            'per_second': (result['per_second'] / before['per_second'] - 1) * 100,
+        }
+    return changes
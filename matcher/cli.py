@@ -3,17 +3,18 @@ from .view import app, get_top_existing, get_existing
 from .model import (Item, Changeset, get_bad, Base, ItemCandidate, Language,
                     LanguageLabel, PlaceItem, OsmCandidate, IsA, User, Extract,
                     ChangesetEdit, EditMatchReject)
-from .place import Place
-from . import database, mail, matcher, nominatim, utils, netstring, wikidata, osm_api
+from .place import Place, PlaceGeomPart
+from . import database, mail, matcher, nominatim, utils, netstring, wikidata, osm_api, benchmark
 from social.apps.flask_app.default.models import UserSocialAuth, Nonce, Association
 from datetime import datetime, timedelta
 from tabulate import tabulate
-from sqlalchemy import inspect, func, cast
+from sqlalchemy import inspect, func, cast, exists
 from geoalchemy2 import Geometry, Geography
 from time import time, sleep
 from pprint import pprint
 from sqlalchemy.types import Enum
 from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.orm import undefer
 from sqlalchemy.dialects.postgresql.base import CreateEnumType
 import unicodedata
 import sqlalchemy.exc
@@ -273,13 +274,66 @@ def run_matcher(place_identifier):
 @app.cli.command()
 @click.argument('place_identifier')
 @click.option('--debug', is_flag=True)
-def place_match(place_identifier, debug):
+@click.option('--workers', type=int, default=1)
+@click.option('--incremental', is_flag=True)
+def place_match(place_identifier, debug, workers, incremental):
     place = get_place(place_identifier)
     place_items = place.matcher_query()
     total = place_items.count()
     print('total:', total)
 
-    place.run_matcher(debug=debug)
+    stats = place.run_matcher(debug=debug, workers=workers,
+                              incremental=incremental).as_dict()
+    for stage, seconds in sorted(stats['seconds'].items(), key=lambda i: -i[1]):
+        print(f'{stage:15s} {seconds:8.2f}s')
+    for name, count in sorted(stats['counts'].items()):
+        print(f'{name:15s} {count:8d}')
+
+@app.cli.command()
+@click.argument('place_identifier')
+@click.argument('filename')
+@click.option('--limit', type=int)
+def record_benchmark(place_identifier, filename, limit):
+    place = get_place(place_identifier)
+    count = benchmark.record(place, filename, limit=limit)
+    print(f'recorded {count} items to {filename}')
+
+@app.cli.command()
+@click.argument('filename')
+@click.option('--repeat', type=int, default=3)
+@click.option('--only', multiple=True, type=click.Choice(benchmark.benchmarks))
+@click.option('--prefix', help='run the candidate search against these tables')
+@click.option('--save', help='write results as JSON')
+@click.option('--compare', 'previous', help='JSON results of an earlier run')
+def run_benchmark(filename, repeat, only, prefix, save, previous):
+    app.config.from_object('config.default')
+    cases = benchmark.load(filename)
+
+    cur = None
+    if prefix:
+        database.init_app(app)
+        cur = database.session.bind.raw_connection().cursor()
+
+    with app.app_context():
+        results = benchmark.run(cases, repeat=repeat, prefix=prefix or 'osm',
+                                cur=cur, only=only)
+    changes = benchmark.compare(results, json.load(open(previous))) if previous else {}
+
+    rows = []
+    for name, r in results.items():
+        row = [name, r['calls'], f"{r['per_second']:,.0f}"]
+        row += [f'{r[p] * 1e6:,.1f}' for p in ('p50', 'p90', 'p99', 'max')]
+        if changes:
+            change = changes.get(name)
+            row.append(f"{change['p50']:+.1f}%" if change else '')
+        rows.append(row)
+    headers = ['benchmark', 'calls', 'per sec', 'p50 µs', 'p90 µs', 'p99 µs', 'max µs']
+    if changes:
+        headers.append('p50 change')
+    print(tabulate(rows, headers=headers))
+
+    if save:
+        json.dump(results, open(save, 'w'), indent=2)
 
 @app.cli.command()
 @click.argument('place_identifier')
@@ -476,6 +530,7 @@ def find_item_matches(place_identifier, qid):
     for k, v in item.names().items():
         print((k, v))
     print('NRHP:', item.ref_nrhp())
+    matcher.prefetch_mission_countries([item])
     candidates = matcher.find_item_matches(cur, item, place.prefix, debug=True)
     print('candidate count:', len(candidates))
 
@@ -503,7 +558,7 @@ def find_ceb():
     app.config.from_object('config.default')
     database.init_app(app)
 
-    q = Item.query.filter(Item.entity.isnot(None))
+    q = Item.query.options(undefer(Item.entity)).filter(Item.entity.isnot(None))
     for item in q:
         sitelinks = item.sitelinks()
         if not sitelinks or 'cebwiki' not in sitelinks or 'enwiki' in sitelinks:
@@ -1106,3 +1161,37 @@ def larger_areas():
         for a in p.is_in():
             print(a['tags'].get('name:en', a['tags']['name']))
         print()
+
+@app.cli.command()
+def slim_entities():
+    ''' rewrite stored entities in the slim format '''
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    last = 0
+    while True:
+        items = (Item.query.options(undefer(Item.entity))
+                           .filter(Item.entity.isnot(None), Item.item_id > last)
+                           .order_by(Item.item_id)
+                           .limit(1000)
+                           .all())
+        if not items:
+            break
+        for item in items:
+            item.entity = item.entity  # the validator slims the entity
+        database.session.commit()
+        last = items[-1].item_id
+        print(last)
+
+@app.cli.command()
+def build_geom_parts():
+    ''' subdivide the geometry of places stored without the parts '''
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    has_parts = exists().where(PlaceGeomPart.place_id == Place.place_id)
+    q = Place.query.filter(Place.geom.isnot(None), ~has_parts)
+    for place in q.all():
+        place.build_geom_parts()
+        database.session.commit()
+        print(place.place_id, place.display_name)
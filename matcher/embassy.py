@@ -1,4 +1,8 @@
-import re
+from flask import has_app_context
+from . import utils, wikidata
+import json
+import os
+import tempfile
 
 entities = [
     {'alpha2': 'CA', 'alpha3': 'CAN', 'label': 'Canada', 'names': ['Canada', 'Canadian', 'Kanada', 'canada'], 'qid': 'Q16'},
@@ -686,15 +690,154 @@ for i in entities:
         reverse_map[name] = i
         reverse_map[name.lower()] = i
 
-longest_first = sorted(reverse_map.keys(), key=len, reverse=True)
+def fold(text):
+    ''' lowercase one character at a time, so positions stay the same '''
+    return ''.join(c.lower()[0] for c in text)
 
-name_pattern = r"(?:\b|')(" + '|'.join(
-        re.escape(n) for n in longest_first) + r')s?\b'
-re_name = re.compile(name_pattern, re.I)
+def is_word_char(c):
+    return c.isalnum() or c == '_'
+
+def is_boundary(text, pos):
+    before = pos > 0 and is_word_char(text[pos - 1])
+    after = pos < len(text) and is_word_char(text[pos])
+    return before != after
+
+class CountryNameDetector:
+    '''Finds the first country name or demonym in a string.
+
+    A character trie of every name from reverse_map, lowercased. Gives the
+    same answer as searching for the names with word boundaries, longest name
+    first, with an optional plural s and an apostrophe allowed before.'''
+
+    def __init__(self, names):
+        self.trie = {}
+        for name in names:
+            node = self.trie
+            for c in fold(name):
+                node = node.setdefault(c, {})
+            node[None] = True  # end of a name
+        self.cache = {}
+
+    def name_ends(self, folded, start):
+        ''' where names starting at start end, longest first '''
+        ends = []
+        node = self.trie
+        for pos in range(start, len(folded)):
+            node = node.get(folded[pos])
+            if node is None:
+                break
+            if None in node:
+                ends.append(pos + 1)
+        return reversed(ends)
+
+    def match_at(self, text, folded, start):
+        for end in self.name_ends(folded, start):
+            if folded[end:end + 1] == 's' and is_boundary(text, end + 1):
+                return end
+            if is_boundary(text, end):
+                return end
+
+    def find(self, text):
+        ''' the country name found in text, as it appears in text '''
+        folded = fold(text)
+        for start in range(len(text) + 1):
+            if is_boundary(text, start):
+                end = self.match_at(text, folded, start)
+                if end:
+                    return text[start:end]
+            if text[start:start + 1] == "'":
+                end = self.match_at(text, folded, start + 1)
+                if end:
+                    return text[start + 1:end]
+
+    def from_name(self, name):
+        if name in self.cache:
+            return self.cache[name]
+        found = self.find(name)
+        country = reverse_map[found.lower()] if found else None
+        if len(self.cache) < max_cache:
+            self.cache[name] = country
+        return country
+
+max_cache = 10_000
+detector = CountryNameDetector(reverse_map.keys())
 
 def from_name(name):
-    m = re_name.search(name)
-    if not m:
+    return detector.from_name(name)
+
+def from_names(names):
+    ''' country for each name, checked together for all candidates '''
+    return {name: detector.from_name(name) for name in set(names) if name}
+
+# country QID -> ISO 3166 alpha-2 and alpha-3 codes, seeded from entities
+iso_codes = {i['qid']: [i[k] for k in ('alpha2', 'alpha3') if k in i]
+             for i in entities}
+iso_codes['Q159583'] = ['VA']  # Holy See
+iso_codes_cache_loaded = False
+
+def iso_codes_cache_filename():
+    return utils.cache_filename('country_iso_codes.json')
+
+def load_iso_codes_cache():
+    global iso_codes_cache_loaded
+    if iso_codes_cache_loaded or not has_app_context():
+        return
+    iso_codes_cache_loaded = True
+    try:
+        cached = json.load(open(iso_codes_cache_filename()))
+    except (OSError, ValueError):
+        return
+    for qid, codes in cached.items():
+        iso_codes.setdefault(qid, codes)
+
+def country_iso_codes(qid):
+    ''' ISO codes for a country, None if it isn't known locally '''
+    if qid not in iso_codes:
+        load_iso_codes_cache()
+    return iso_codes.get(qid)
+
+def iso_codes_for_countries(qids):
+    ''' all the ISO codes for the countries, None if any are unknown '''
+    codes = set()
+    for qid in qids:
+        country_codes = country_iso_codes(qid)
+        if country_codes is None:
+            return
+        codes.update(country_codes)
+    return codes
+
+def iso_codes_from_entity(entity):
+    ''' ISO 3166 codes from the claims, empty for operators that aren't countries '''
+    claims = entity.get('claims') or {}
+    codes = [wikidata.claim_value(c) for pid in ('P297', 'P298')
+             for c in claims.get(pid, [])]
+    return [code for code in codes if code is not None]
+
+def save_iso_codes_cache(found):
+    ''' add to the cache file, replaced in one step so a matcher process
+    reading it never sees a partly written file '''
+    filename = iso_codes_cache_filename()
+    try:
+        cached = json.load(open(filename))
+    except (OSError, ValueError):
+        cached = {}
+    cached.update(found)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    with os.fdopen(fd, 'w') as out:
+        json.dump(cached, out)
+    os.replace(tmp, filename)
+
+def fetch_country_iso_codes(qids):
+    ''' look up countries missing from the registry on Wikidata and save
+    them in the cache, call before matching starts '''
+    missing = sorted(qid for qid in qids if country_iso_codes(qid) is None)
+    if not missing:
         return
-    lc_match = m.group(1).lower()
-    return reverse_map[m] if m in reverse_map else reverse_map[lc_match]
+
+    found = {qid: [] for qid in missing}
+    for chunk in utils.chunk(missing, 50):
+        for entity in wikidata.get_entities(list(chunk), props='claims'):
+            if entity.get('id') in found:
+                found[entity['id']] = iso_codes_from_entity(entity)
+    iso_codes.update(found)
+    save_iso_codes_cache(found)
@@ -134,7 +134,7 @@ def send_traceback(info):
     send_mail(subject, body)
 
 def datavalue_missing(field, entity):
-    qid = entity['title']
+    qid = entity['id']  # slim_entity drops 'title'
     body = f'https://www.wikidata.org/wiki/{qid}\n\n{pformat(entity)}'
 
     subject = f'{qid}: datavalue missing in {field}'
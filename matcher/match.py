@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 from collections import defaultdict
+from functools import cached_property, lru_cache
 from unidecode import unidecode
 from num2words import num2words
 from .utils import remove_start, normalize_url, any_upper
@@ -53,6 +54,10 @@ re_address_common_end = re.compile('^(.+)(' + '|'.join(abbr.keys()) + '|plaza)$'
 
 re_road_end = re.compile('^(.+)(' + '|'.join(list(road_abbr.keys()) + list(road_abbr.values())) + ') *$', re.I)
 
+generic_endings = ['companybuilding', 'building', 'complex', 'office']
+
+max_name_forms = 50_000  # strings kept by name_forms before the oldest are dropped
+
 bad_name_fields = {'tiger:name_base', 'name:right',
                    'name:left', 'gnis:county_name', 'openGeoDB:name'}
 
@@ -227,8 +232,8 @@ def split_on_upper_and_tidy(name):
 def name_containing_initials(n1, n2):
     if not any_upper(n1) or not any_upper(n2):
         return False
-    n1_split = split_on_upper_and_tidy(n1)
-    n2_split = split_on_upper_and_tidy(n2)
+    n1_split = name_forms(n1).upper_split
+    n2_split = name_forms(n2).upper_split
 
     if len(n1_split) != len(n2_split) or len(n1_split) < 3:
         endings = [' centre', ' center']
@@ -266,6 +271,132 @@ def plural_word_name_in_other_name(n1, n2):
             n1 not in n2 and
             n1[:-1] in n2)
 
+class NameForms:
+    '''Derived forms of a name, each worked out on first use.'''
+
+    def __init__(self, name):
+        self.name = name
+
+    @cached_property
+    def lc(self):
+        return self.name.lower()
+
+    @cached_property
+    def term_set(self):
+        return frozenset(self.lc.split())
+
+    @cached_property
+    def stripped(self):
+        return re_strip_non_chars.sub('', self.lc)
+
+    @cached_property
+    def stripped_dash(self):
+        return re_strip_non_chars_and_dash.sub('', self.lc)
+
+    @cached_property
+    def tidy1(self):
+        '''tidy, but keep the lead article'''
+        return tidy_name(self.lc)
+
+    @cached_property
+    def tidy2(self):
+        return strip_words(self.tidy1)
+
+    @cached_property
+    def tidy(self):
+        return drop_article(self.tidy2)
+
+    @cached_property
+    def tidy_stripped_dash(self):
+        '''all three tidy forms with non chars and dashes removed'''
+        tidy_forms = {self.tidy, self.tidy1, self.tidy2}
+        return frozenset(re_strip_non_chars_and_dash.sub('', n) for n in tidy_forms) - {''}
+
+    @cached_property
+    def upper_split(self):
+        return tuple(split_on_upper_and_tidy(self.name))
+
+    @cached_property
+    def final_tidy(self):
+        '''tidy forms used by the last steps of name_match_main'''
+        tidy = self.tidy
+        if 'washington, d' in tidy:
+            return {tidy, tidy.replace('washington, d', 'washington d')}
+        return {tidy}
+
+    @cached_property
+    def centre_trimmed(self):
+        '''this name plus the versions name_containing_initials tries with
+        centre or center removed from the end'''
+        found = {self.name}
+        todo = [self.name]
+        while todo:
+            name = todo.pop()
+            for end in ' centre', ' center':
+                if name.lower().endswith(end) and name[:-len(end)] not in found:
+                    found.add(name[:-len(end)])
+                    todo.append(name[:-len(end)])
+        return found
+
+    @cached_property
+    def initials_rescue(self):
+        '''could be initials, or have an initial that matches a whole word'''
+        if upper_stable(self.name):
+            return True
+        return any(len(part) == 1
+                   for name in self.centre_trimmed
+                   for part in name_forms(name).upper_split)
+
+    @cached_property
+    def match_keys(self):
+        '''strings a name_match_main match implies both names share,
+        leaving out those that depend on endings'''
+        keys = {self.lc, self.tidy1, self.tidy2, self.tidy}
+        keys |= self.term_set | self.tidy_stripped_dash
+        keys |= {self.stripped, self.stripped_dash} - {''}
+        for name in self.centre_trimmed:
+            keys |= set(name_forms(name).upper_split)
+
+        for tidy in self.tidy, self.tidy1, self.tidy2:
+            keys.add(re_strip_non_chars.sub('', tidy))
+            comma = tidy.rfind(', ')
+            if comma != -1:
+                keys |= {tidy[:comma], re_strip_non_chars.sub('', tidy[:comma])}
+
+        for tidy in self.final_tidy:
+            keys |= set(tidy.split()) or {''}
+            tidy = re_keep_commas.sub('', tidy)
+            comma = tidy.rfind(', ')
+            if comma != -1:
+                keys.add(tidy[:comma])
+            keys.add(tidy)
+            keys |= trimmed_versions(re_strip_non_chars.sub('', tidy), generic_endings)
+        return frozenset(keys)
+
+    @cached_property
+    def no_initials(self):
+        return drop_initials(self.name)
+
+    @cached_property
+    def normalized(self):
+        return normalize_name(self.name)
+
+@lru_cache(maxsize=max_name_forms)
+def name_forms(name):
+    ''' shared NameForms for a string, least recently used are dropped '''
+    return NameForms(name)
+
+def clear_name_forms():
+    name_forms.cache_clear()
+
+def forms_match(forms1, forms2, strip_dash=False):
+    ''' strip_non_chars_match using the cached forms of the lowercase names '''
+    if strip_dash:
+        stripped1, stripped2 = forms1.stripped_dash, forms2.stripped_dash
+    else:
+        stripped1, stripped2 = forms1.stripped, forms2.stripped
+    return bool(stripped1) and stripped1 == stripped2
+
 def name_match_main(osm, wd, endings=None, debug=False):
     if not wd or not osm:
         return
@@ -275,20 +406,22 @@ def name_match_main(osm, wd, endings=None, debug=False):
     if wd == osm:
         return Match(MatchType.good, 'identical')
 
-    osm_lc, wd_lc = osm.lower(), wd.lower()
+    osm_forms, wd_forms = name_forms(osm), name_forms(wd)
+    osm_lc, wd_lc = osm_forms.lc, wd_forms.lc
 
     historic = ' (historic)'
     if osm_lc.endswith(historic):
         osm = osm[:-len(historic)]
-        osm_lc = osm_lc[:-len(historic)]
+        osm_forms = name_forms(osm)
+        osm_lc = osm_forms.lc
 
     if wd_lc == osm_lc:
         return Match(MatchType.good, 'identical except case')
 
-    if set(osm_lc.split()) == set(wd_lc.split()):
+    if osm_forms.term_set == wd_forms.term_set:
         return Match(MatchType.good, 'matching term sets')
 
-    if strip_non_chars_match(osm_lc, wd_lc, strip_dash=True):
+    if forms_match(osm_forms, wd_forms, strip_dash=True):
         return Match(MatchType.good, 'strip non chars and dash')
 
     if name_containing_initials(osm, wd):
@@ -306,12 +439,12 @@ def name_match_main(osm, wd, endings=None, debug=False):
     if m:
         return m
 
-    if strip_non_chars_match(osm_lc, wd_lc):
+    if forms_match(osm_forms, wd_forms):
         return Match(MatchType.good, 'strip non chars')
 
     # tidy names, but don't drop lead article yet
-    wd_tidy1 = tidy_name(wd_lc)
-    osm_tidy1 = tidy_name(osm_lc)
+    wd_tidy1 = wd_forms.tidy1
+    osm_tidy1 = osm_forms.tidy1
 
     if not wd_tidy1 or not osm_tidy1:
         return
@@ -319,14 +452,14 @@ def name_match_main(osm, wd, endings=None, debug=False):
     if wd_tidy1 == osm_tidy1:
         return Match(MatchType.good, 'tidy')
 
-    wd_tidy2 = strip_words(wd_tidy1)
-    osm_tidy2 = strip_words(osm_tidy1)
+    wd_tidy2 = wd_forms.tidy2
+    osm_tidy2 = osm_forms.tidy2
 
     if wd_tidy2 == osm_tidy2:
         return Match(MatchType.good, 'strip words')
 
-    wd_tidy = drop_article(wd_tidy2)
-    osm_tidy = drop_article(osm_tidy2)
+    wd_tidy = wd_forms.tidy
+    osm_tidy = osm_forms.tidy
 
     wd_names = {wd_tidy, wd_tidy1, wd_tidy2}
     osm_names = {osm_tidy, osm_tidy1, osm_tidy2}
@@ -345,15 +478,13 @@ def name_match_main(osm, wd, endings=None, debug=False):
                             plural_word_name_in_other_name(wd_lc, osm_lc))
 
     if endings:
-        tidy_endings = [tidy_name(e) for e in endings]
+        tidy_endings = [name_forms(e).tidy1 for e in endings]
         m = match_with_words_removed(osm_tidy, wd_tidy, tidy_endings)
         if m and not plural_in_other_name:
             return m
 
-    for osm_name in osm_names:
-        for wd_name in wd_names:
-            if strip_non_chars_match(osm_name, wd_name, strip_dash=True):
-                return Match(MatchType.good, 'strip non chars and dash after tidy')
+    if osm_forms.tidy_stripped_dash & wd_forms.tidy_stripped_dash:
+        return Match(MatchType.good, 'strip non chars and dash after tidy')
 
     if 'washington, d' in wd_tidy:  # special case for Washington, D.C.
         wd_tidy = wd_tidy.replace('washington, d', 'washington d')
@@ -384,9 +515,7 @@ def name_match_main(osm, wd, endings=None, debug=False):
     if plural_in_other_name:
         return
 
-    generic = ['companybuilding', 'building', 'complex', 'office']
-
-    for end in generic + list(endings or []):
+    for end in generic_endings + list(endings or []):
         if wd_tidy.endswith(end) and wd_tidy[:-len(end)] == osm_tidy:
             return Match(MatchType.trim)
         if wd_tidy.startswith(end) and wd_tidy[len(end):] == osm_tidy:
@@ -489,7 +618,7 @@ def name_match(osm, wd, endings=None, debug=False, place_names=None):
                           '+ strip non letter start')
             return match
 
-    osm_no_intitals = drop_initials(osm)
+    osm_no_intitals = name_forms(osm).no_initials
     if osm_no_intitals:
         match = name_match_main(osm_no_intitals, wd, endings, debug)
         if match:
@@ -590,7 +719,7 @@ def check_name_matches_address(osm_tags, wikidata_names):
                    for name in set(number_start)
                    if ',' in name]
     number_start.update(n for n in strip_comma if not n.isdigit())
-    norm_number_start = {normalize_name(name) for name in number_start}
+    norm_number_start = {name_forms(name).normalized for name in number_start}
 
     postcode = osm_tags.get('addr:postcode')
     if postcode:
@@ -598,7 +727,7 @@ def check_name_matches_address(osm_tags, wikidata_names):
 
     if 'addr:housenumber' in osm_tags and 'addr:street' in osm_tags:
         osm_address = osm_tags['addr:housenumber'] + ' ' + osm_tags['addr:street']
-        norm_osm_address = normalize_name(osm_address)
+        norm_osm_address = name_forms(osm_address).normalized
         if any(name == norm_osm_address for name in norm_number_start):
             return True
 
@@ -609,7 +738,7 @@ def check_name_matches_address(osm_tags, wikidata_names):
                 continue
 
             if (re_uk_postcode_start.match(postcode_start) and
-                    normalize_name(name) == norm_osm_address):
+                    name_forms(name).normalized == norm_osm_address):
                 return True
 
         if any(name.startswith(norm_osm_address) or norm_osm_address.startswith(name)
@@ -623,7 +752,7 @@ def check_name_matches_address(osm_tags, wikidata_names):
                 return
 
     if 'addr:full' in osm_tags:
-        osm_address = normalize_name(osm_tags['addr:full'])
+        osm_address = name_forms(osm_tags['addr:full']).normalized
         if any(osm_address.startswith(name) for name in norm_number_start):
             return True
 
@@ -631,7 +760,7 @@ def check_name_matches_address(osm_tags, wikidata_names):
             name, _, postcode_start = i.rpartition(' ')
 
             if (re_uk_postcode_start.match(postcode_start) and
-                    normalize_name(name) == osm_address):
+                    name_forms(name).normalized == osm_address):
                 return True
 
     # if we find a name from wikidata matches the OSM name we can be more relaxed
@@ -648,6 +777,131 @@ def intials_matches_other_wikidata_name(initials, wikidata_names):
     return any(w != initials and initials_match(initials, w)
                for w in wikidata_names.keys())
 
+def upper_stable(name):
+    chars = [c for c in name if c.isalnum()]
+    return len(chars) >= 3 and all(c == c.upper() for c in chars)
+
+def trimmed_versions(name, ends):
+    versions = {name}
+    for end in ends:
+        if name.endswith(end):
+            versions.add(name[:-len(end)])
+        if name.startswith(end):
+            versions.add(name[len(end):])
+    return versions
+
+def removed_versions(name, words):
+    return {name.replace(word, '') for word in words} | {name}
+
+def name_variants(name, role, place_names=None, operator=None):
+    ''' the strings name_match can pass to name_match_main for this name,
+    with a flag for the street parts that get road words as extra endings '''
+    yield name, False
+    for place_name in more_place_name_varients(place_names or []):
+        yield strip_place_name(name, place_name), False
+
+    stripped = name.strip()
+    if stripped and stripped[0].isdigit():
+        m = re_road_end.match(stripped)
+        if m:
+            yield m.group(1), False
+
+    and_list = [sep for sep in ('&', ' and ', ' And ') if sep in name]
+    if len(and_list) == 1:
+        part1, _, part2 = name.partition(and_list[0])
+        yield part1, True
+        yield part2, True
+
+    if role == 'wikidata':
+        for start in 'Tomb of ', 'Statue of ', 'Memorial to ':
+            if name.startswith(start):
+                yield name[len(start):], False
+        end = ' And Attached Railings'.lower()
+        if name.lower().endswith(end):
+            yield name[:-len(end)], False
+        return
+
+    name_lc = name.lower()
+    for start in 'old ', 'the old ', 'former ', 'disused ', 'site of':
+        if name_lc.startswith(start):
+            yield name[len(start):], False
+    if name and name[0].isdigit():
+        yield strip_non_letter_start(name), False
+    no_initials = drop_initials(name)
+    if no_initials:
+        yield no_initials, False
+
+    if ';' in name:
+        for part in name.split(';'):
+            yield from name_variants(part.strip(), role, place_names)
+    if operator and name_lc.startswith(operator):
+        yield from name_variants(name[len(operator):].rstrip(), role, place_names)
+
+def name_keys(name, role, endings, place_names=None, operator=None):
+    ''' keys for the name index, None if the name could match anything '''
+    road_endings = endings | set(road_abbr.keys()) | set(road_abbr.values())
+
+    keys = set()
+    for variant, street_part in name_variants(name, role, place_names, operator):
+        variant = variant.strip()
+        if not variant:
+            continue
+        variant_forms = [name_forms(variant)]
+        if variant_forms[0].lc.endswith(' (historic)'):
+            variant_forms.append(name_forms(variant[:-len(' (historic)')]))
+
+        variant_endings = road_endings if street_part else endings
+        words = [re_strip_non_chars.sub('', w) for w in variant_endings]
+        tidy_words = [re_strip_non_chars.sub('', name_forms(e).tidy1)
+                      for e in variant_endings]
+
+        for forms in variant_forms:
+            if forms.initials_rescue:
+                return
+            for end in variant_endings:
+                if forms.lc.endswith(end.lower()):
+                    if upper_stable(forms.name[:-len(end)].strip()):
+                        return
+
+            keys |= forms.match_keys
+            keys |= removed_versions(forms.stripped_dash, words)
+            tidy_char_only = re_strip_non_chars_and_dash.sub('', forms.tidy)
+            keys |= removed_versions(tidy_char_only, tidy_words)
+            for tidy in forms.final_tidy:
+                final = re_strip_non_chars.sub('', re_keep_commas.sub('', tidy))
+                keys |= trimmed_versions(final, variant_endings)
+
+    return keys
+
+def name_pairs_to_check(osm_names, wikidata_names, endings,
+                        place_names=None, operator=None):
+    ''' (OSM name, Wikidata name) pairs that share a key and so could match
+
+    Pairs without a shared token, initials or trimmed form can't match, the
+    name_match cascade is skipped for them. '''
+    index = defaultdict(set)
+    always = set()
+    for w in wikidata_names:
+        keys = name_keys(w, 'wikidata', endings, place_names)
+        # name_match_main drops endings based on ' at ', keep that side effect
+        if keys is None or ' at ' in w.lower():
+            always.add(w)
+            continue
+        for key in keys:
+            index[key].add(w)
+
+    pairs = set()
+    for o in set(osm_names):
+        keys = name_keys(o, 'osm', endings, place_names, operator)
+        if keys is None:
+            pairs.update((o, w) for w in wikidata_names)
+            continue
+        found = set(always)
+        for key in keys:
+            found |= index.get(key, set())
+        pairs.update((o, w) for w in found)
+    return pairs
+
 def check_for_match(osm_tags, wikidata_names, endings=None, place_names=None, trim_house=True):
     endings = set(endings or [])
     if trim_house:
@@ -673,10 +927,15 @@ def check_for_match(osm_tags, wikidata_names, endings=None, place_names=None, tr
             'a ' + city,   # Italian
         }
 
+    pairs = name_pairs_to_check(names.values(), wikidata_names, endings,
+                                place_names=place_names, operator=operator)
+
     name = defaultdict(list)
     cache = {}
     for w, source in wikidata_names.items():
         for osm_key, o in names.items():
+            if (o, w) not in pairs:
+                continue
             if (o, w) in cache:
                 result = cache[(o, w)]
                 if not result:
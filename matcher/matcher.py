@@ -1,61 +1,224 @@
 from flask import current_app
 from collections import Counter, defaultdict
-from . import match, database, wikidata, embassy
+from contextlib import contextmanager, nullcontext
+from time import perf_counter, monotonic
+from . import match, database, embassy
+from geoalchemy2.elements import WKBElement
+import psycopg2.extras
 
 import os.path
 import json
 import re
+import hashlib
 
 cat_to_ending = {}
 patterns = {}
-entity_types = {}
+entity_types = None  # EntityTypes registry, see get_entity_types
+entity_types_check_interval = 60  # seconds between checks for a changed file
 default_max_dist = 4
 extract_name_good_enough = True
+match_profiles = {}  # memoised profiles, see match_profile_key
+category_classifier = None
+max_category_cache = 100_000
+max_match_profiles = 10_000
+
+diplomatic_tags = {'amenity=embassy', 'office=diplomatic', 'diplomatic'}
+# part of every match fingerprint, bump when a matcher change can alter candidates
+MATCHER_VERSION = 1
 
 re_farmhouse = re.compile('^(.*) farm ?house$', re.I)
 
+class MatchStats:
+    '''Seconds spent in each stage of find_item_matches, plus counters.'''
+
+    def __init__(self):
+        self.seconds = Counter()
+        self.counts = Counter()
+
+    @contextmanager
+    def timer(self, stage):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += perf_counter() - t0
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def count(self, name, num=1):
+        self.counts[name] += num
+
+    def update(self, other):
+        self.seconds.update(other['seconds'])
+        self.counts.update(other['counts'])
+
+    def as_dict(self):
+        seconds = dict(self.seconds)
+        if 'candidate_loop' in seconds:
+            # time in the per-row loop not spent in the three match checks
+            checks = sum(seconds.get(stage, 0)
+                         for stage in ('identifier', 'address', 'name_match'))
+            seconds['rules'] = max(seconds['candidate_loop'] - checks, 0)
+        return {'seconds': seconds, 'counts': dict(self.counts)}
+
+class NullStats:
+    def timer(self, stage):
+        return nullcontext()
+
+    def add(self, stage, seconds):
+        pass
+
+    def count(self, name, num=1):
+        pass
+
+null_stats = NullStats()
+
 def get_pattern(key):
     if key in patterns:
         return patterns[key]
     return patterns.setdefault(key, re.compile(r'\b' + re.escape(key) + r'\b', re.I))
 
-def categories_to_tags(categories, cat_to_entity=None):
-    if cat_to_entity is None:
-        cat_to_entity = build_cat_map()
-    tags = set()
-    for cat in categories:
-        lc_cat = cat.lower()
+class CategoryClassifier:
+    '''Category to OSM tags, built once from the entity types.
+
+    A single regex of every category key rules out most categories with one
+    search, the rest are checked key by key. Results are kept per category.'''
+
+    registry = None
+
+    def __init__(self, types):
+        cat_to_entity = build_cat_map(types)
+        self.entries = []
         for key, value in cat_to_entity.items():
-            if not get_pattern(key).search(lc_cat):
-                continue
             exclude = value.get('exclude_cats')
             if exclude:
-                pattern = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
-                if pattern.search(lc_cat):
+                exclude = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
+            self.entries.append((get_pattern(key), exclude, frozenset(value['tags'])))
+
+        keys = sorted(cat_to_entity.keys(), key=len, reverse=True)
+        self.any_key = re.compile(r'\b(?:' + '|'.join(re.escape(k) for k in keys) + r')\b', re.I)
+        self.cache = {}
+
+    def category_tags(self, cat):
+        if cat in self.cache:
+            return self.cache[cat]
+        if len(self.cache) >= max_category_cache:
+            self.cache.clear()
+
+        lc_cat = cat.lower()
+        tags = set()
+        if self.any_key.search(lc_cat):
+            for pattern, exclude, entity_tags in self.entries:
+                if not pattern.search(lc_cat):
+                    continue
+                if exclude and exclude.search(lc_cat):
                     continue
-            tags |= set(value['tags'])
+                tags |= entity_tags
+        tags = self.cache[cat] = frozenset(tags)
+        return tags
+
+def get_category_classifier():
+    global category_classifier
+
+    registry = get_entity_types()
+    if category_classifier is None or category_classifier.registry is not registry:
+        category_classifier = CategoryClassifier(registry.types)
+        category_classifier.registry = registry
+    return category_classifier
+
+def categories_to_tags(categories, classifier=None):
+    classifier = classifier or get_category_classifier()
+    tags = set()
+    for cat in categories:
+        tags |= classifier.category_tags(cat)
     return sorted(tags)
 
 def categories_to_tags_map(categories):
-    cat_to_entity = build_cat_map()
+    classifier = get_category_classifier()
     ret = defaultdict(set)
     for cat in categories:
-        lc_cat = cat.lower()
-        for key, value in cat_to_entity.items():
-            if not get_pattern(key).search(lc_cat):
-                continue
-            exclude = value.get('exclude_cats')
-            if exclude:
-                pattern = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
-                if pattern.search(lc_cat):
-                    continue
-            ret[cat] |= set(value['tags'])
+        tags = classifier.category_tags(cat)
+        if tags:
+            ret[cat] |= tags
     return ret
 
+def entity_types_filename():
+    return os.path.join(current_app.config['DATA_DIR'], 'entity_types.json')
+
 def load_entity_types():
-    data_dir = current_app.config['DATA_DIR']
-    filename = os.path.join(data_dir, 'entity_types.json')
-    return json.load(open(filename))
+    return json.load(open(entity_types_filename()))
+
+class EntityTypes:
+    '''Entity types indexed by OSM tag and by Wikidata item.
+
+    Trim endings, max distance and the check_housename flag are combined per
+    tag and per item when loaded, so the criteria lookups are dict lookups.'''
+
+    def __init__(self, types, filename=None, mtime=None):
+        self.types = types
+        self.filename = filename
+        self.mtime = mtime
+        self.checked = monotonic()
+        self._digest = None
+
+        self.by_tag = defaultdict(list)
+        self.by_qid = defaultdict(list)
+        for t in types:
+            for tag in set(t['tags']):
+                self.by_tag[tag].append(t)
+            if t.get('wikidata'):
+                self.by_qid[t['wikidata']].append(t)
+
+        self.tag_endings = {tag: frozenset(e for t in found for e in t.get('trim', []))
+                            for tag, found in self.by_tag.items()}
+        self.tag_max_dist = {}
+        for tag, found in self.by_tag.items():
+            dists = [t['dist'] for t in found if t.get('dist')]
+            if dists:
+                self.tag_max_dist[tag] = max(dists)
+        self.tag_check_housename = {tag for tag, found in self.by_tag.items()
+                                    if any(t.get('check_housename') for t in found)}
+        self.qid_check_housename = {qid: any(t.get('check_housename') for t in found)
+                                    for qid, found in self.by_qid.items()}
+
+    @classmethod
+    def load(cls):
+        filename = entity_types_filename()
+        mtime = os.path.getmtime(filename)
+        return cls(json.load(open(filename)), filename, mtime)
+
+    @property
+    def digest(self):
+        ''' hash of the entity types, changes when the file is edited '''
+        if self._digest is None:
+            data = json.dumps(self.types, sort_keys=True)
+            self._digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        return self._digest
+
+    def is_stale(self):
+        ''' has the file changed since it was loaded, checked at most once
+        every entity_types_check_interval seconds '''
+        if not self.filename or monotonic() - self.checked < entity_types_check_interval:
+            return False
+        self.checked = monotonic()
+        try:
+            return os.path.getmtime(self.filename) != self.mtime
+        except OSError:
+            return False
+
+def get_entity_types():
+    ''' the entity type registry, reloaded when entity_types.json changes '''
+    global entity_types
+
+    if entity_types is None or entity_types.is_stale():
+        entity_types = EntityTypes.load()
+    return entity_types
+
+def reload_entity_types():
+    global entity_types
+    entity_types = None
+    return get_entity_types()
 
 def simplify_tags(tags):
     ''' remove foo=bar if dict cotains foo '''
@@ -77,9 +240,9 @@ def tag_and_key_if_possible(tags):
                 continue
     return tags
 
-def build_cat_map():
+def build_cat_map(types=None):
     cat_to_entity = {}
-    for i in load_entity_types():
+    for i in types or load_entity_types():
         for c in i['cats']:
             lc_cat = c.lower()
             if ' by ' in lc_cat:
@@ -88,17 +251,13 @@ def build_cat_map():
     return cat_to_entity
 
 def get_ending_from_criteria(tags):
-    global entity_types
-
-    if not entity_types:
-        entity_types = load_entity_types()
+    tag_endings = get_entity_types().tag_endings
     tags = set(tags)
     tags.discard('type=site')  # too generic
 
     endings = set()
-    for t in entity_types:
-        if tags & set(t['tags']):
-            endings.update(t.get('trim', []))
+    for tag in tags:
+        endings.update(tag_endings.get(tag, ()))
 
     return endings
 
@@ -111,93 +270,165 @@ def could_be_building(tags, instanceof):
     if any(tag.startswith('building') for tag in tags):
         return True
 
-    global entity_types
-
-    if not entity_types:
-        entity_types = load_entity_types()
+    registry = get_entity_types()
 
-    check_housename = False
-    found_instanceof = False
     if instanceof:
-        for t in entity_types:
-            if t.get('wikidata') not in instanceof:
-                continue
-            found_instanceof = True
-            if t.get('check_housename'):
-                check_housename = True
-    if found_instanceof:
-        return check_housename
+        found = [registry.qid_check_housename[qid] for qid in instanceof
+                 if qid in registry.qid_check_housename]
+        if found:
+            return any(found)
 
-    tags = set(tags)
-    return any(t.get('check_housename') and tags & set(t['tags'])
-               for t in entity_types)
+    return any(tag in registry.tag_check_housename for tag in tags)
 
 def get_max_dist_from_criteria(tags):
-    global entity_types
-
-    if not entity_types:
-        entity_types = load_entity_types()
-    tags = set(tags)
-
-    max_dists = []
-    for t in entity_types:
-        type_max_dist = t.get('dist')
-        if type_max_dist and tags & set(t['tags']):
-            max_dists.append(type_max_dist)
-
+    tag_max_dist = get_entity_types().tag_max_dist
+    max_dists = [tag_max_dist[tag] for tag in set(tags) if tag in tag_max_dist]
     return max(max_dists) if max_dists else None
 
 def hstore_query(tags):
-    '''hstore query for use with osm2pgsql database'''
-    cond = []
+    '''hstore query for use with osm2pgsql database
+
+    Returns SQL and parameters. The ?| test on the keys can be answered by
+    the GIN index osm2pgsql builds on tags, values are then checked against
+    the semicolon separated list.'''
+    keys = []
+    values = []
+    params = {}
     for tag in tags:
         if '=' not in tag:
-            cond.append(f"(tags ? '{tag}')")
+            keys.append(tag)
             continue
         k, v = tag.split('=')
-        cond.append(f"('{v}' = any(string_to_array((tags->'{k}'), ';')))")
+        keys.append(k)
+        num = len(values)
+        params[f'k{num}'] = k
+        params[f'v{num}'] = v
+        values.append(f"(%(v{num})s = any(string_to_array((tags->%(k{num})s), ';')))")
         if '_' not in v:
             continue
-        space = v.replace('_', ' ')
-        cond.append(f"('{space}' = any(string_to_array((tags->'{k}'), ';')))")
+        params[f's{num}'] = v.replace('_', ' ')
+        values.append(f"(%(s{num})s = any(string_to_array((tags->%(k{num})s), ';')))")
+
+    only_keys = [tag for tag in tags if '=' not in tag]
+    params['keys'] = sorted(set(keys))
+    cond = []
+    if only_keys:
+        params['only_keys'] = only_keys
+        cond.append('(tags ?| %(only_keys)s)')
+    cond += values
 
-    return ' or\n '.join(cond)
+    sql = '(tags ?| %(keys)s) and (' + ' or\n '.join(cond) + ')'
+    return sql, params
 
 def nearby_nodes_sql(item, prefix, max_dist=10, limit=50):
-    point = f"ST_TRANSFORM(ST_GeomFromEWKT('{item.ewkt}'), 3857)"
+    point = 'ST_TRANSFORM(ST_GeomFromEWKT(%(ewkt)s), 3857)'
     sql = (f"select 'point', osm_id, name, tags, "
            f'ST_Distance({point}, way) as dist '
            f'from {prefix}_point '
-           f'where ST_DWithin({point}, way, {max_dist})')
-    return sql
+           f'where ST_DWithin({point}, way, %(max_dist)s)')
+    return sql, {'ewkt': item.ewkt, 'max_dist': max_dist}
 
 def item_match_sql(item, prefix, ignore_tags=None, limit=50):
-    point = "ST_TRANSFORM(ST_GeomFromEWKT('{}'), 3857)".format(item.ewkt)
+    point = 'ST_TRANSFORM(ST_GeomFromEWKT(%(ewkt)s), 3857)'
     item_max_dist = get_max_dist_from_criteria(item.tags) or default_max_dist
 
     tags = item.calculate_tags(ignore_tags=ignore_tags)
     if not tags:
         return
 
-    hstore = hstore_query(tags)
+    hstore, params = hstore_query(tags)
     assert hstore
+    params.update(ewkt=item.ewkt, max_dist=item_max_dist * 1000, limit=limit)
 
     sql_list = []
     for obj_type in 'point', 'line', 'polygon':
         obj_sql = (f"select '{obj_type}', osm_id, name, tags, "
                    f'ST_Distance({point}, way) as dist '
                    f'from {prefix}_{obj_type} '
-                   f'where ST_DWithin({point}, way, {item_max_dist} * 1000)')
+                   f'where ST_DWithin({point}, way, %(max_dist)s)')
         sql_list.append(obj_sql)
     sql = ('select * from (' + ' union '.join(sql_list) +
-            f') a where ({hstore}) order by dist limit {limit}')
+            f') a where ({hstore}) order by dist limit %(limit)s')
+    return sql, params
+
+def batch_match_sql(prefix, limit=50):
+    '''candidate search for every item in the match_item temp table
+
+    Same rows as item_match_sql followed by nearby_nodes_sql, with the
+    item_id as the first column. The hstore test from hstore_query is done
+    in SQL against the array of item tags, after the indexable ?| test.'''
+
+    values = "string_to_array(a.tags->split_part(tag, '=', 1), ';')"
+    tag_match = ('exists (select 1 from unnest(i.match_tags) t(tag) where '
+                 "case when position('=' in tag) = 0 then a.tags ? tag "
+                 f"else split_part(tag, '=', 2) = any({values}) or "
+                 "replace(split_part(tag, '=', 2), '_', ' ') "
+                 f'= any({values}) end)')
+
+    sql_list = []
+    for obj_type in 'point', 'line', 'polygon':
+        obj_sql = (f"select '{obj_type}' as src_type, osm_id, name, tags, "
+                   'ST_Distance(i.point, way) as dist '
+                   f'from {prefix}_{obj_type} '
+                   'where ST_DWithin(i.point, way, i.max_dist * 1000)')
+        sql_list.append(obj_sql)
+
+    sql = ('select i.item_id, 0 as part, m.* from match_item i '
+           'cross join lateral (select * from (' + ' union '.join(sql_list) +
+           f') a where a.tags ?| i.match_keys and {tag_match} '
+           f'order by dist limit {limit}) m '
+           "where i.match_tags != '{}' "
+           'union all '
+           "select i.item_id, 1, 'point', osm_id, name, p.tags, "
+           'ST_Distance(i.point, way) '
+           f'from match_item i join {prefix}_point p '
+           'on ST_DWithin(i.point, way, 10) '
+           'order by item_id, part, dist')
     return sql
 
-def run_sql(cur, sql, debug=False):
+def batch_match_item(item):
+    profile = get_match_profile(item)
+    ignore_tags = {'building'} if profile.is_a_historic_district else set()
+    tags = item.calculate_tags(ignore_tags=ignore_tags)
+    max_dist = get_max_dist_from_criteria(item.tags) or default_max_dist
+    keys = {tag.partition('=')[0] for tag in tags}
+    return (item.item_id, item.ewkt, max_dist, sorted(tags), sorted(keys))
+
+def find_batch_rows(cur, items, prefix, debug=False):
+    '''candidate rows for many items in a single query
+
+    Returns a dict mapping item_id to the rows find_item_matches would get
+    from item_match_sql and nearby_nodes_sql.'''
+
+    items = [item for item in items
+             if item and item.entity and get_match_profile(item).names]
+    rows = {item.item_id: [] for item in items}
+    if not items:
+        return rows
+
+    cur.execute('create temp table if not exists match_item ('
+                'item_id integer primary key, point geometry, '
+                'max_dist float, match_tags text[], match_keys text[])')
+    cur.execute('truncate match_item')
+    template = ('(%s, ST_Transform(ST_GeomFromEWKT(%s), 3857), %s, '
+                '%s::text[], %s::text[])')
+    psycopg2.extras.execute_values(cur,
+                                   'insert into match_item values %s',
+                                   [batch_match_item(item) for item in items],
+                                   template=template)
+
+    sql = batch_match_sql(prefix)
+    for item_id, part, *row in run_sql(cur, sql, debug=debug):
+        rows[item_id].append(tuple(row))
+    return rows
+
+def run_sql(cur, sql, params=None, debug=False):
     if debug:
         print(sql)
+        if params:
+            print(params)
 
-    cur.execute(sql)
+    cur.execute(sql, params)
     return cur.fetchall()
 
 def find_nrhp_match(nrhp_numbers, rows):
@@ -281,6 +512,22 @@ def is_diplomatic_mission(matching_tags, osm_tags):
             return True
     return False
 
+def diplomatic_mission_countries(items):
+    ''' operators of the items, any of them can match an OSM embassy
+
+    Items without diplomatic tags still match OSM objects named as
+    embassies, so every P137 is included.'''
+    qids = set()
+    for item in items:
+        if item.entity:
+            qids.update(operator['id'] for operator in item.get_claim('P137'))
+    return qids
+
+def prefetch_mission_countries(items):
+    ''' look up ISO codes for the operators of the items, call before
+    find_item_matches, the candidate loop doesn't make requests '''
+    embassy.fetch_country_iso_codes(diplomatic_mission_countries(items))
+
 def is_building_only_match(matching_tags):
     building_tags = {'building', 'building=yes', 'historic:building'}
     return matching_tags.issubset(building_tags)
@@ -408,57 +655,157 @@ def is_bad_match(item, osm_tags):
 
     return False
 
-def find_item_matches(cur, item, prefix, debug=False):
+class ItemMatchProfile:
+    '''The parts of an item needed by the matcher, worked out once.'''
+
+    def __init__(self, item):
+        self.item_id = item.item_id
+        self.names = item.names()
+        self.categories = item.categories or []
+        self.identifiers = item.get_item_identifiers()
+        self.nrhp_numbers = item.ref_nrhp()
+        self.tags = item.calculate_tags()
+
+        self.endings = get_ending_from_criteria(item.tags)
+        self.endings |= item.more_endings_from_isa()
+
+        self.place_names = item.place_names()
+        self.instanceof = set(item.instanceof())
+        self.is_hamlet = item.is_hamlet()
+        self.is_farmhouse = item.is_farmhouse()
+        self.is_a_historic_district = item.is_a_historic_district()
+        self.is_a_stadium = item.is_a_stadium()
+        self.is_mountain_range = item.is_mountain_range()
+        self.is_nhle = bool(item.is_nhle)
+
+def entity_revision(entity):
+    '''lastrevid, or a hash of the entity when it was saved without one'''
+    if not entity:
+        return None
+    if entity.get('lastrevid'):
+        return entity['lastrevid']
+    data = json.dumps(entity, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def item_match_key(item):
+    '''entity revision plus the item columns the matcher reads'''
+    return (item.item_id,
+            entity_revision(item.entity),
+            tuple(sorted(item.tags)),
+            tuple(item.categories or []),
+            tuple(item.extract_names or []))
+
+def match_profile_key(item):
+    '''everything a profile is worked out from
+
+    The item, the addresses of its places and the revisions of its IsA
+    items, so a memoised profile is still right after a refresh.'''
+    places = sorted((place.place_id, json.dumps(place.address, sort_keys=True))
+                    for place in item.places)
+    isa = sorted((isa.item_id, entity_revision(isa.entity)) for isa in item.isa)
+    return (get_entity_types().digest,) + item_match_key(item) + (
+            tuple(places), tuple(isa))
+
+def match_fingerprint(item, rows):
+    '''hash of everything find_item_matches works from
+
+    The matcher version, entity types, item, extract, place names, endings
+    from IsA items and nearby OSM rows.'''
+    profile = get_match_profile(item)
+    extract = hashlib.sha1((item.extract or '').encode('utf-8')).hexdigest()
+    osm = sorted(json.dumps(row, sort_keys=True) for row in rows)
+    data = json.dumps([MATCHER_VERSION,
+                       get_entity_types().digest,
+                       item_match_key(item),
+                       extract,
+                       sorted(profile.place_names),
+                       sorted(profile.endings),
+                       osm])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def get_match_profile(item):
+    '''memoised ItemMatchProfile, shared by matcher runs and the views
+
+    The profile is also kept on the item object, places and IsA items are
+    only read the first time it is needed.'''
+    if item.item_id is None or not item.entity:
+        return ItemMatchProfile(item)  # not saved yet
+
+    item_key = item_match_key(item)
+    on_item = getattr(item, 'match_profile', None)
+    if on_item and on_item[0] == item_key:
+        return on_item[1]
+
+    key = match_profile_key(item)
+    profile = match_profiles.get(key)
+    if not profile:
+        if len(match_profiles) >= max_match_profiles:
+            match_profiles.clear()
+        profile = ItemMatchProfile(item)
+        match_profiles[key] = profile
+    item.match_profile = (item_key, profile)
+    return profile
+
+def find_item_matches(cur, item, prefix, debug=False, rows=None, stats=None):
     if not item or not item.entity:
         return []
-    wikidata_names = item.names()
+    stats = stats or null_stats
+    stats.count('items')
+    profile = get_match_profile(item)
+    wikidata_names = profile.names
     if not wikidata_names:
         return []
 
-    cats = item.categories or []
+    cats = profile.categories
 
     # point = "ST_GeomFromEWKT('{}')".format(item.ewkt)
 
     # item_max_dist = max(max_dist[cat] for cat in item['cats'])
 
-    item_is_a_historic_district = item.is_a_historic_district()
-    ignore_tags = {'building'} if item_is_a_historic_district else set()
-    sql = item_match_sql(item, prefix, ignore_tags=ignore_tags)
-    rows = run_sql(cur, sql, debug) if sql else []
+    item_is_a_historic_district = profile.is_a_historic_district
+    if rows is None:  # not already found by find_batch_rows
+        ignore_tags = {'building'} if item_is_a_historic_district else set()
+        query = item_match_sql(item, prefix, ignore_tags=ignore_tags)
+        with stats.timer('tag_sql'):
+            rows = run_sql(cur, *query, debug=debug) if query else []
 
-    sql = nearby_nodes_sql(item, prefix)
-    rows += run_sql(cur, sql, debug)
+        sql, params = nearby_nodes_sql(item, prefix)
+        with stats.timer('nearby_sql'):
+            rows += run_sql(cur, sql, params, debug=debug)
     if not rows:
         return []
+    stats.count('rows', len(rows))
 
     if debug:
         print('row count:', len(rows))
         print()
     seen = set()
 
-    nrhp_numbers = item.ref_nrhp()
+    nrhp_numbers = profile.nrhp_numbers
     if nrhp_numbers:
         found = find_nrhp_match(nrhp_numbers, rows)
         if found:
             return found
 
-    item_identifiers = item.get_item_identifiers()
+    item_identifiers = profile.identifiers
 
-    endings = get_ending_from_criteria(item.tags)
-    endings |= item.more_endings_from_isa()
+    endings = set() if profile.is_farmhouse else set(profile.endings)
 
-    if item.is_farmhouse():
-        endings = set()
+    wikidata_tags = profile.tags
 
-    wikidata_tags = item.calculate_tags()
-
-    place_names = item.place_names()
-    instanceof = set(item.instanceof())
-    is_hamlet = item.is_hamlet()
+    place_names = profile.place_names
+    instanceof = profile.instanceof
+    is_hamlet = profile.is_hamlet
     if is_hamlet:
         endings.discard('house')
 
+    # ISO codes come from prefetch_mission_countries, None if not fetched
+    item_countries = {country['id'] for country in item.get_claim('P137')}
+    mission_codes = embassy.iso_codes_for_countries(item_countries)
+
     candidates = []
+    name_countries = None
+    loop_start = perf_counter()
     for osm_num, (src_type, src_id, osm_name, osm_tags, dist) in enumerate(rows):
 
         (osm_type, osm_id) = get_osm_id_and_type(src_type, src_id)
@@ -479,27 +826,31 @@ def find_item_matches(cur, item, prefix, debug=False):
         except Exception:
             admin_level = None
 
-        identifier_match = match.check_identifier(osm_tags, item_identifiers)
+        with stats.timer('identifier'):
+            identifier_match = match.check_identifier(osm_tags, item_identifiers)
 
         if not identifier_match:
             if any(c.startswith('Cities ') for c in cats) and admin_level == 10:
                 continue
 
-        address_match = match.check_name_matches_address(osm_tags,
-                                                         wikidata_names)
+        with stats.timer('address'):
+            address_match = match.check_name_matches_address(osm_tags,
+                                                             wikidata_names)
 
         if address_match is False:  # OSM and Wikidata addresses differ
             continue
 
-        if (not address_match and
-                match.check_for_address_in_extract(osm_tags, item.extract)):
-            address_match = True
+        with stats.timer('address'):
+            if (not address_match and
+                    match.check_for_address_in_extract(osm_tags, item.extract)):
+                address_match = True
 
-        name_match = match.check_for_match(osm_tags,
-                                           wikidata_names,
-                                           endings,
-                                           place_names=place_names,
-                                           trim_house=not is_hamlet)
+        with stats.timer('name_match'):
+            name_match = match.check_for_match(osm_tags,
+                                               wikidata_names,
+                                               endings,
+                                               place_names=place_names,
+                                               trim_house=not is_hamlet)
 
         if 'seamark:name' in name_match and 'man_made=lighthouse' not in item.tags:
             del name_match['seamark:name']  # not a lighthouse
@@ -513,19 +864,20 @@ def find_item_matches(cur, item, prefix, debug=False):
             name = osm_tags.get('name:en') or osm_tags.get('name')
             country = (osm_tags.get('diplomatic:sending_country') or
                     osm_tags.get('country'))
-            item_countries = {country['id'] for country in item.get_claim('P137')}
 
             if country and 'country' in osm_tags:
-                codes = set()
-                for qid in item_countries:
-                    codes.update(wikidata.country_iso_codes_from_qid(qid))
-
+                # an unknown operator can't confirm the country
                 osm_country = osm_tags['country'].upper()
                 if (len(osm_country) in (2, 3) and
-                        all(iso_code.upper() != osm_country for iso_code in codes)):
+                        (mission_codes is None or
+                         all(iso_code.upper() != osm_country
+                             for iso_code in mission_codes))):
                     continue
             elif name:
-                name_country = embassy.from_name(name)
+                if name_countries is None:  # all the candidate names at once
+                    name_countries = embassy.from_names(
+                        row[3].get('name:en') or row[3].get('name') for row in rows)
+                name_country = name_countries.get(name)
                 if name_country and name_country['qid'] not in item_countries:
                     continue
 
@@ -567,7 +919,7 @@ def find_item_matches(cur, item, prefix, debug=False):
                 building_only_match):
             if bad_building_match(osm_tags, name_match, item):
                 continue
-            wd_stadium = item.is_a_stadium()
+            wd_stadium = profile.is_a_stadium
             if (wd_stadium and 'amenity=restaurant' not in item.tags and
                     'restaurant' in amenity):
                 continue
@@ -575,20 +927,13 @@ def find_item_matches(cur, item, prefix, debug=False):
                 continue
 
         if (matching_tags == {'natural=peak'} and
-                item.is_mountain_range() and
+                profile.is_mountain_range and
                 dist > 100):
             continue
 
-        if item.is_nhle and dist > 500:
+        if profile.is_nhle and dist > 500:
             continue  # NHLE items normally have quite precise coordinates
 
-        sql = (f'select ST_AsText(ST_Transform(way, 4326)) '
-               f'from {prefix}_{src_type} '
-               f'where osm_id={src_id}')
-        cur.execute(sql)
-        row = cur.fetchone()
-        geom = row and row[0]
-
         candidate = {
             'osm_type': osm_type,
             'osm_id': osm_id,
@@ -598,22 +943,54 @@ def find_item_matches(cur, item, prefix, debug=False):
             # 'match': match.match_type.name,
             'planet_table': src_type,
             'src_id': src_id,
-            'geom': geom,
+            'geom': None,
             'identifier_match': identifier_match,
             'address_match': address_match,
             'name_match': name_match,
             'matching_tags': matching_tags,
         }
         candidates.append(candidate)
-    candidates = filter_distant(candidates)
-    candidates = prefer_tag_match_over_building_only_match(candidates)
-    candidates = prefer_railway_station(candidates)
-    if candidates and item.is_farmhouse():
-        candidates = prefer_farmhouse(candidates)
-    if 'man_made=bridge' in item.tags:
-        candidates = filter_bridge(candidates)
+    stats.add('candidate_loop', perf_counter() - loop_start)
+
+    with stats.timer('post_filters'):
+        candidates = filter_distant(candidates)
+        candidates = prefer_tag_match_over_building_only_match(candidates)
+        candidates = prefer_railway_station(candidates)
+        if candidates and profile.is_farmhouse:
+            candidates = prefer_farmhouse(candidates)
+        if 'man_made=bridge' in item.tags:
+            candidates = filter_bridge(candidates)
+    if candidates:
+        with stats.timer('geom'):
+            add_candidate_geom(cur, candidates, prefix)
+    stats.count('candidates', len(candidates))
     return candidates
 
+def candidate_geom_sql(candidates, prefix):
+    src_ids = defaultdict(set)
+    for c in candidates:
+        src_ids[c['planet_table']].add(c['src_id'])
+
+    sql_list = []
+    for src_type, ids in sorted(src_ids.items()):
+        id_list = ', '.join(str(src_id) for src_id in sorted(ids))
+        sql_list.append(f"select '{src_type}', osm_id, "
+                        'ST_AsEWKB(ST_Transform(way, 4326)) '
+                        f'from {prefix}_{src_type} '
+                        f'where osm_id in ({id_list})')
+    return ' union all '.join(sql_list)
+
+def add_candidate_geom(cur, candidates, prefix):
+    ''' fetch the geometry for all candidates in one query, as EWKB '''
+    cur.execute(candidate_geom_sql(candidates, prefix))
+    geoms = {}
+    for src_type, src_id, ewkb in cur.fetchall():
+        geom = WKBElement(bytes(ewkb), srid=4326, extended=True)
+        geoms.setdefault((src_type, src_id), geom)
+
+    for c in candidates:
+        c['geom'] = geoms.get((c['planet_table'], c['src_id']))
+
 def prefer_tag_match_over_building_only_match(candidates):
     if len(candidates) == 1:
         return candidates
@@ -666,24 +1043,24 @@ def filter_bridge(candidates):
 
 def check_item_candidate(candidate):
     item, osm_tags = candidate.item, candidate.tags
-    cats = item.categories or []
-    item_identifiers = item.get_item_identifiers()
-    wikidata_names = item.names()
+    profile = get_match_profile(item)
+    cats = profile.categories
+    item_identifiers = profile.identifiers
+    wikidata_names = profile.names
 
-    wikidata_tags = item.calculate_tags()
+    wikidata_tags = profile.tags
 
-    endings = get_ending_from_criteria(item.tags)
-    endings |= item.more_endings_from_isa()
+    endings = set(profile.endings)
 
-    place_names = item.place_names()
-    instanceof = set(item.instanceof())
+    place_names = profile.place_names
+    instanceof = profile.instanceof
 
     try:
         admin_level = int(osm_tags['admin_level']) if 'admin_level' in osm_tags else None
     except Exception:
         admin_level = None
 
-    if item.is_a_historic_district() and 'building' in osm_tags:
+    if profile.is_a_historic_district and 'building' in osm_tags:
         return {'reject': "historic district shouldn't match building"}
     identifier_match = match.check_identifier(osm_tags, item_identifiers)
     if not identifier_match:
@@ -700,7 +1077,7 @@ def check_item_candidate(candidate):
             match.check_for_address_in_extract(osm_tags, item.extract)):
         address_match = True
 
-    is_hamlet = item.is_hamlet()
+    is_hamlet = profile.is_hamlet
 
     if is_hamlet:
         endings.discard('house')
@@ -757,7 +1134,7 @@ def check_item_candidate(candidate):
                 'reject': 'bad building match',
             }
 
-        wd_stadium = item.is_a_stadium()
+        wd_stadium = profile.is_a_stadium
         if (wd_stadium and 'amenity=restaurant' not in item.tags and
                 'restaurant' in amenity):
             return {'reject': "stadium shouldn't match restaurant"}
@@ -765,7 +1142,7 @@ def check_item_candidate(candidate):
             return {'reject': "stadium shouldn't match supermarket"}
 
     if (matching_tags == {'natural=peak'} and
-            item.is_mountain_range() and
+            profile.is_mountain_range and
             candidate.dist > 100):
         return {'reject': "mountain range shouldn't match peak"}
 
@@ -782,6 +1159,7 @@ def run_individual_match(place, item):
     conn = database.session.bind.raw_connection()
     cur = conn.cursor()
 
+    prefetch_mission_countries([item])
     candidates = find_item_matches(cur, item, place.prefix, debug=False)
     conn.close()
 
@@ -8,7 +8,7 @@ from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from geoalchemy2 import Geography  # noqa: F401
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.orm import relationship, backref, column_property
+from sqlalchemy.orm import relationship, backref, column_property, validates, deferred
 from sqlalchemy.sql.expression import cast
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from .database import session, now_utc
@@ -31,6 +31,14 @@ osm_type_enum = postgresql.ENUM('node', 'way', 'relation',
                                 name='osm_type_enum',
                                 metadata=Base.metadata)
 
+class CandidateGeography(Geography):
+    ''' Geography that accepts EWKB as well as WKT
+
+    ST_GeogFromText can't parse EWKB, casting a literal to geography can.'''
+
+    def bind_expression(self, bindvalue):
+        return cast(bindvalue, Geography(srid=4326))
+
 # also check for tags that start with 'disused:'
 disused_prefix_key = {'amenity', 'railway', 'leisure', 'tourism',
                       'man_made', 'shop', 'building'}
@@ -118,13 +126,21 @@ class Extract(Base):
         self.site = site
         self.extract = extract
 
+def label_from_labels(labels, lang='en'):
+    if lang in labels:
+        return labels[lang]['value']
+    elif lang != 'en' and 'en' in labels:
+        return labels['en']['value']
+    elif labels:  # JSONB doesn't keep key order, pick the same one every time
+        return labels[min(labels)]['value']
+
 class Item(Base):
     __tablename__ = 'item'
 
     item_id = Column(Integer, primary_key=True, autoincrement=False)
     location = Column(Geography('POINT', spatial_index=True), nullable=False)
     enwiki = Column(String, index=True)
-    entity = Column(postgresql.JSON)
+    entity = deferred(Column(postgresql.JSONB))  # undefer when reading many items
     categories = Column(postgresql.ARRAY(String))
     old_tags = Column(postgresql.ARRAY(String))
     qid = column_property('Q' + cast(item_id, String))
@@ -147,6 +163,10 @@ class Item(Base):
                                  backref='item')
     extracts = association_proxy('wiki_extracts', 'extract')
 
+    @validates('entity')
+    def validate_entity(self, key, entity):
+        return wikidata.slim_entity(entity)
+
     @property
     def extract(self):
         return self.extracts.get('enwiki')
@@ -167,13 +187,7 @@ class Item(Base):
         if not self.entity:
             return self.enwiki or self.query_label or None
 
-        labels = self.entity['labels']
-        if lang in labels:
-            return labels[lang]['value']
-        elif lang != 'en' and 'en' in labels:
-            return labels['en']['value']
-        elif labels:
-            return list(labels.values())[0]['value']
+        return label_from_labels(self.entity['labels'], lang=lang)
 
     def label_best_language(self, languages):
         if not languages:
@@ -212,6 +226,19 @@ class Item(Base):
         if qid and len(qid) > 1 and qid[0].upper() == 'Q' and qid[1:].isdigit():
             return cls.query.get(qid[1:])
 
+    @classmethod
+    def stored_revisions(cls, qids):
+        ''' lastrevid and download profile of the entity stored for each item '''
+        item_ids = [int(qid[1:]) for qid in qids]
+        if not item_ids:
+            return {}
+        q = (session.query(cls.item_id,
+                           cls.entity['lastrevid'].astext,
+                           cls.entity['profile'].astext)
+                    .filter(cls.item_id.in_(item_ids), cls.entity.isnot(None)))
+        return {'Q{}'.format(item_id): (int(revid), profile)
+                for item_id, revid, profile in q if revid}
+
     def label_and_qid(self, lang='en'):
         label = self.label(lang=lang)
         if label:
@@ -598,6 +625,7 @@ class PlaceItem(Base):
     osm_id = Column(BigInteger, primary_key=True)
     place_id = Column(BigInteger)  # unused, replaced by osm_type & osm_id
     done = Column(Boolean)
+    match_fingerprint = Column(String)  # inputs to the last match, see matcher
 
     __table_args__ = (
         ForeignKeyConstraint(
@@ -628,7 +656,7 @@ class ItemCandidate(Base):
     tags = Column(postgresql.JSON)
     planet_table = Column(String)
     src_id = Column(BigInteger)
-    geom = Column(Geography(srid=4326, spatial_index=True))
+    geom = Column(CandidateGeography(srid=4326, spatial_index=True))
     geojson = column_property(func.ST_AsGeoJSON(geom), deferred=True)
     identifier_match = Column(Boolean)
     address_match = Column(Boolean)
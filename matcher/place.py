@@ -1,27 +1,41 @@
-from flask import current_app, url_for, g, abort
-from .model import Base, Item, ItemCandidate, PlaceItem, ItemTag, Changeset, IsA, ItemIsA, osm_type_enum, get_bad
+from flask import Flask, current_app, url_for, g, abort
+from .model import Base, Item, ItemCandidate, PlaceItem, ItemTag, Changeset, ChangesetEdit, BadMatch, IsA, ItemIsA, osm_type_enum, get_bad, label_from_labels
 from sqlalchemy.types import BigInteger, Float, Integer, JSON, String, DateTime, Boolean
-from sqlalchemy import func, select, cast
+from sqlalchemy import func, select, cast, exists, tuple_, and_
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.schema import ForeignKeyConstraint, ForeignKey, Column, UniqueConstraint
-from sqlalchemy.orm import relationship, backref, column_property, object_session, deferred, load_only
+from sqlalchemy.orm import relationship, backref, column_property, object_session, deferred, load_only, undefer, contains_eager
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.sql.expression import true, false, or_
 from geoalchemy2 import Geography, Geometry
 from sqlalchemy.ext.hybrid import hybrid_property
-from .database import session, get_tables, now_utc
-from . import wikidata, matcher, wikipedia, overpass, utils, nominatim, default_change_comments
-from collections import Counter
+from .database import session, get_tables, now_utc, init_db
+from . import wikidata, match, matcher, embassy, wikipedia, overpass, utils, nominatim, default_change_comments, spatial_index
+from collections import Counter, defaultdict
 from .overpass import oql_from_tag
 from time import time
+from concurrent.futures import ProcessPoolExecutor
+from _queue import SimpleQueue  # the C version, gevent doesn't patch it
 
 import json
 import subprocess
 import os.path
 import re
+import math
+import itertools
+import multiprocessing
+import threading
 
 radius_default = 1_000  # in metres, only for nodes
 
 place_chunk_size = 32
+match_batch_size = 500  # items per candidate search query
+save_chunk_size = 100  # items per candidate upsert and commit
+wikidata_tile_items = 2_000  # aim for this many items per wikidata bbox query
+wikidata_tile_min = 4  # tile side in km
+wikidata_tile_max = 128
+subdivide_max_vertices = 256  # ST_Subdivide pieces for spatial predicates
+display_simplify_tolerance = 0.0005  # degrees, roughly 50m
 degrees = '(-?[0-9.]+)'
 re_box = re.compile(rf'^BOX\({degrees} {degrees},{degrees} {degrees}\)$')
 
@@ -73,6 +87,154 @@ def envelope(bbox):
     ymin, ymax, xmin, xmax = bbox
     return func.ST_MakeEnvelope(xmin, ymin, xmax, ymax, 4326)
 
+def chunk_table(chunks):
+    ''' list of bbox chunks as a subquery with num, south, north, west, east '''
+    columns = [list(range(len(chunks)))] + [list(c) for c in zip(*chunks)]
+    types = [Integer, Float, Float, Float, Float]
+    names = ['num', 'south', 'north', 'west', 'east']
+    return (select([func.unnest(cast(values, postgresql.ARRAY(t))).label(name)
+                    for values, t, name in zip(columns, types, names)])
+            .alias('chunks'))
+
+def chunk_table_envelope(grid):
+    return func.ST_MakeEnvelope(grid.c.west, grid.c.south,
+                                grid.c.east, grid.c.north, 4326)
+
+worker_index = None  # spatial index for the place, one per matcher process
+
+def match_worker_init(config, prefix):
+    ''' app context, database connection and spatial index for a matcher process '''
+    global worker_index
+    app = Flask(__name__)
+    app.config.update(config)
+    app.app_context().push()
+    init_db(config['DB_URL'])
+
+    if config.get('MATCHER_SPATIAL_INDEX') and spatial_index.shapely:
+        conn = session.bind.raw_connection()
+        worker_index = spatial_index.PlaceIndex.load(conn.cursor(), prefix)
+        conn.close()
+
+def match_worker(prefix, item_ids, fingerprints=None):
+    ''' find candidates for a batch of items, called in a worker process
+
+    With fingerprints from a previous run, unchanged items get None in place
+    of a candidate list.'''
+    conn = session.bind.raw_connection()
+    cur = conn.cursor()
+    stats = matcher.MatchStats()
+
+    items = {item.item_id: item
+             for item in (Item.query.options(undefer(Item.entity))
+                                    .filter(Item.item_id.in_(item_ids)))}
+    skip = {item_id for item_id, item in items.items()
+            if item.skip_item_during_match()}
+    to_match = [item for item_id, item in items.items() if item_id not in skip]
+    if worker_index is not None:
+        with stats.timer('index_search'):
+            batch_rows = {item.item_id: worker_index.find_rows(item)
+                          for item in to_match}
+    else:
+        with stats.timer('batch_sql'):
+            batch_rows = matcher.find_batch_rows(cur, to_match, prefix)
+
+    results = []
+    for item_id in item_ids:
+        if item_id in skip:
+            results.append((item_id, None, []))
+            continue
+        rows = batch_rows.get(item_id)
+        fingerprint = matcher.match_fingerprint(items[item_id], rows or [])
+        if fingerprints and fingerprints.get(item_id) == fingerprint:
+            candidates = None
+        else:
+            candidates = matcher.find_item_matches(cur, items[item_id], prefix,
+                                                   rows=rows, stats=stats)
+        results.append((item_id, fingerprint, candidates))
+
+    conn.close()
+    session.remove()
+    return results, stats.as_dict()
+
+def run_match_pool(prefix, item_ids, fingerprints, workers, config, results):
+    ''' match batches of items in a pool of processes
+
+    Each (results, stats) from a worker goes on the results queue, then None
+    when finished or the exception if the pool fails. The pool belongs to this
+    call, so it can be run in a thread away from the gevent hub.'''
+    ctx = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=ctx,
+                                 initializer=match_worker_init,
+                                 initargs=(config, prefix)) as executor:
+            prefixes = itertools.repeat(prefix)
+            for result in executor.map(match_worker, prefixes,
+                                       item_ids, fingerprints):
+                results.put(result)
+    except Exception as e:
+        results.put(e)
+        return
+    results.put(None)
+
+def delete_stale_candidates(item_ids, keep):
+    ''' remove candidates of these items that aren't in keep
+
+    Candidates with saved edits are left, foreign keys mean we can't remove
+    them.'''
+    table = ItemCandidate.__table__
+    has_edit = exists().where(and_(ChangesetEdit.item_id == table.c.item_id,
+                                   ChangesetEdit.osm_id == table.c.osm_id,
+                                   ChangesetEdit.osm_type == table.c.osm_type))
+    stale = (select([table.c.item_id, table.c.osm_id, table.c.osm_type])
+             .where(and_(table.c.item_id.in_(item_ids), ~has_edit)))
+    if keep:
+        key = tuple_(table.c.item_id, table.c.osm_id, table.c.osm_type)
+        stale = stale.where(key.notin_(keep))
+
+    bad_match = BadMatch.__table__
+    bad_match_key = tuple_(bad_match.c.item_id,
+                           bad_match.c.osm_id,
+                           bad_match.c.osm_type)
+    session.execute(bad_match.delete().where(bad_match_key.in_(stale)))
+    key = tuple_(table.c.item_id, table.c.osm_id, table.c.osm_type)
+    session.execute(table.delete().where(key.in_(stale)))
+
+def upsert_candidates(rows):
+    ''' insert or update candidates with INSERT ... ON CONFLICT
+
+    Only the keys present in a candidate are updated, like
+    ItemCandidate.update.'''
+    table = ItemCandidate.__table__
+    by_keys = defaultdict(list)
+    for row in rows:
+        by_keys[tuple(sorted(row.keys()))].append(row)
+
+    for keys, group in by_keys.items():
+        stmt = postgresql.insert(table).values(group)
+        update = {k: stmt.excluded[k] for k in keys
+                  if k not in {'item_id', 'osm_id', 'osm_type'}}
+        stmt = stmt.on_conflict_do_update(index_elements=table.primary_key.columns,
+                                          set_=update)
+        session.execute(stmt)
+
+def save_candidates(found):
+    ''' save candidates for a chunk of items, found is (item_id, candidates) '''
+    columns = set(ItemCandidate.__table__.columns.keys())
+    keep = []
+    rows = []
+    for item_id, candidates in found:
+        for c in candidates:
+            keep.append((item_id, c['osm_id'], c['osm_type']))
+            row = {k: v for k, v in c.items() if k in columns}
+            row['item_id'] = item_id
+            rows.append(row)
+
+    # if this is a refresh we remove candidates that no longer match
+    delete_stale_candidates([item_id for item_id, candidates in found], keep)
+    if rows:
+        upsert_candidates(rows)
+
 class Place(Base):
     __tablename__ = 'place'
     place_id = Column(BigInteger, primary_key=True, autoincrement=False)
@@ -104,10 +266,13 @@ class Place(Base):
     item_types_retrieved = Column(Boolean, default=False)
     index_hide = Column(Boolean, default=False)
     overpass_is_in = deferred(Column(JSON))
+    display_geom = deferred(Column(Geometry(srid=4326)))
 
     area = column_property(func.ST_Area(geom))
     geometry_type = column_property(func.GeometryType(geom))
     geojson = column_property(func.ST_AsGeoJSON(geom, 4), deferred=True)
+    display_geojson = column_property(func.ST_AsGeoJSON(display_geom, 4),
+                                      deferred=True)
     srid = column_property(func.ST_SRID(geom))
     # match_ratio = column_property(candidate_count / item_count)
     num_geom = column_property(func.ST_NumGeometries(cast(geom, Geometry)),
@@ -224,6 +389,8 @@ class Place(Base):
         return (not self.bad_geom_type and self.allowed_cat and self.area_in_range)
 
     def update_from_nominatim(self, hit):
+        if self.place_id != int(hit['place_id']) or self.geom_changed(hit['geotext']):
+            self.clear_geom_parts()  # built again by ensure_geom_parts
         if self.place_id != int(hit['place_id']):
             print((self.place_id, hit['place_id']))
             self.place_id = hit['place_id']
@@ -240,6 +407,16 @@ class Place(Base):
         self.wikidata = hit['extratags'].get('wikidata')
         self.geom = hit['geotext']
 
+    def geom_changed(self, geotext):
+        ''' is the geometry from nominatim different to the stored one '''
+        if self.geom is None:
+            return True
+        same = func.ST_OrderingEquals(cast(Place.geom, Geometry),
+                                      func.ST_GeomFromText(geotext, 4326))
+        return not (session.query(same)
+                           .filter(Place.place_id == self.place_id)
+                           .scalar())
+
     def change_comment(self, item_count):
         if item_count == 1:
             return g.user.single or default_change_comments['single']
@@ -356,34 +533,121 @@ class Place(Base):
         # Would be nice to include OSM chunk information with each
         # item. Not doing it at this point because it means lots
         # of queries. Easier once the items are loaded into the database.
-        return {k: v for k, v in items.items() if self.covers(v)}
+        covered = self.covered_qids(items)
+        return {k: v for k, v in items.items() if k in covered}
 
     def items_from_wikidata(self, query_map):
-        rows = wikidata.run_query(query_map['enwiki'])
-        items = wikidata.parse_enwiki_query(rows)
+        # the queries run in parallel, results are merged in a fixed order
+        names = ['enwiki', 'hq_enwiki', 'item_tag', 'hq_item_tag']
+        results = wikidata.run_queries({name: query_map[name] for name in names})
+
+        def query_rows(name):
+            if isinstance(results[name], wikidata.QueryError):
+                raise results[name]
+            return results[name]
+
+        items = wikidata.parse_enwiki_query(query_rows('enwiki'))
 
         try:  # add items with the coordinates in the HQ field
-            rows = wikidata.run_query(query_map['hq_enwiki'])
-            items.update(wikidata.parse_enwiki_query(rows))
+            items.update(wikidata.parse_enwiki_query(query_rows('hq_enwiki')))
         except wikidata.QueryError:
             pass  # HQ query timeout isn't fatal
 
-        rows = wikidata.run_query(query_map['item_tag'])
-        wikidata.parse_item_tag_query(rows, items)
+        wikidata.parse_item_tag_query(query_rows('item_tag'), items)
 
         try:  # add items with the coordinates in the HQ field
-            rows = wikidata.run_query(query_map['hq_item_tag'])
-            wikidata.parse_item_tag_query(rows, items)
+            wikidata.parse_item_tag_query(query_rows('hq_item_tag'), items)
         except wikidata.QueryError:
             pass  # HQ query timeout isn't fatal
 
         return items
 
+    def clear_geom_parts(self):
+        with session.no_autoflush:
+            (session.query(PlaceGeomPart)
+                    .filter_by(place_id=self.place_id)
+                    .delete(synchronize_session=False))
+        self.display_geom = None
+        self.geom_parts_stored = False
+
+    def build_geom_parts(self):
+        ''' subdivide the geometry for spatial predicates and save a
+        simplified copy for maps '''
+        self.clear_geom_parts()
+        session.flush()
+        geom = cast(Place.geom, Geometry)
+        parts = (select([Place.place_id,
+                         func.ST_Subdivide(geom, subdivide_max_vertices)])
+                 .where(Place.place_id == self.place_id))
+        session.execute(PlaceGeomPart.__table__.insert()
+                                     .from_select(['place_id', 'geom'], parts))
+        self.display_geom = (session.query(func.ST_SimplifyPreserveTopology(
+                                               geom, display_simplify_tolerance))
+                                    .filter(Place.place_id == self.place_id)
+                                    .scalar())
+        session.flush()
+        self.geom_parts_stored = True
+
+    def has_geom_parts(self):
+        stored = getattr(self, 'geom_parts_stored', None)
+        if stored is None:
+            q = exists().where(PlaceGeomPart.place_id == self.place_id)
+            stored = self.geom_parts_stored = session.query(q).scalar()
+        return stored
+
+    def ensure_geom_parts(self):
+        ''' build the parts on the first match of a place, not when a search
+        or browse request stores it '''
+        if self.geom is not None and not self.has_geom_parts():
+            self.build_geom_parts()
+            session.commit()
+
+    def geom_parts(self):
+        ''' subquery with the pieces of the geometry in a geom column
+
+        Places that haven't been matched since they were stored or their
+        geometry changed have the whole geometry as one piece.'''
+        stored = self.has_geom_parts()
+
+        if stored:
+            q = (select([PlaceGeomPart.geom])
+                 .where(PlaceGeomPart.place_id == self.place_id))
+        else:
+            q = (select([cast(Place.geom, Geometry).label('geom')])
+                 .where(Place.place_id == self.place_id))
+        return q.alias('parts')
+
+    def map_geojson(self):
+        ''' simplified geometry as GeoJSON for drawing on a map '''
+        return self.display_geojson or self.geojson
+
     def covers(self, item):
         ''' Is the given item within the geometry of this place. '''
-        q = (select([func.ST_Covers(Place.geom, item['location'])])
-                .where(Place.place_id == self.place_id))
-        return object_session(self).scalar(q)
+        parts = self.geom_parts()
+        point = func.ST_GeomFromText(item['location'], 4326)
+        q = exists().where(func.ST_Covers(parts.c.geom, point))
+        return object_session(self).query(q).scalar()
+
+    def covered_qids(self, items):
+        ''' QIDs of the items within the geometry of this place, one query
+
+        The points are tested against the subdivided geometry, small pieces
+        keep complex coastlines quick to test. '''
+        if not items:
+            return set()
+        parts = self.geom_parts()
+        qids = list(items.keys())
+        locations = [items[qid]['location'] for qid in qids]
+        points = (select([func.unnest(cast(qids, postgresql.ARRAY(String))).label('qid'),
+                          func.unnest(cast(locations, postgresql.ARRAY(String))).label('location')])
+                  .alias('points'))
+        covers = func.ST_Covers(parts.c.geom,
+                                func.ST_GeomFromText(points.c.location, 4326))
+        q = (object_session(self).query(points.c.qid)
+                                 .select_from(points)
+                                 .join(parts, covers)
+                                 .distinct())
+        return {qid for qid, in q}
 
     def add_tags_to_items(self):
         for item in self.items.filter(Item.categories != '{}'):
@@ -438,7 +702,7 @@ class Place(Base):
         return os.path.exists(self.overpass_filename)
 
     def items_with_candidates(self):
-        return self.items.join(ItemCandidate)
+        return self.items.join(ItemCandidate).options(undefer(Item.entity))
 
     def items_with_candidates_count(self):
         if self.state != 'ready':
@@ -452,7 +716,9 @@ class Place(Base):
                        .count())
 
     def items_without_candidates(self):
-        return self.items.outerjoin(ItemCandidate).filter(ItemCandidate.item_id.is_(None))
+        return (self.items.outerjoin(ItemCandidate)
+                          .filter(ItemCandidate.item_id.is_(None))
+                          .options(undefer(Item.entity)))
 
     def items_with_multiple_candidates(self):
         # select count(*) from (select 1 from item, item_candidate where item.item_id=item_candidate.item_id) x;
@@ -494,7 +760,8 @@ class Place(Base):
         return self.name.replace(':', '').replace(' ', '_')
 
     def items_with_instanceof(self):
-        return [item for item in self.items if item.instanceof()]
+        return [item for item in self.items.options(undefer(Item.entity))
+                if item.instanceof()]
 
     def osm2pgsql_cmd(self, filename=None):
         if filename is None:
@@ -564,7 +831,8 @@ class Place(Base):
         re_paren = re.compile(r'\(.+\)')
         re_drop = re.compile(r'\b(the|and|at|of|de|le|la|les|von)\b')
         names = set()
-        for building in (item for item in self.items if 'building' in item.tags):
+        items = self.items.options(undefer(Item.entity))
+        for building in (item for item in items if 'building' in item.tags):
             for n in building.names():
                 if n[0].isdigit() and ',' in n:
                     continue
@@ -678,9 +946,11 @@ class Place(Base):
 
     def item_list(self):
         lang = self.most_common_language() or 'en'
-        q = self.items.filter(Item.entity.isnot(None)).order_by(Item.item_id)
-        return [{'id': i.item_id, 'name': i.label(lang=lang)}
-                for i in q]
+        q = (self.items.with_entities(Item.item_id, Item.entity['labels'])
+                       .filter(Item.entity.isnot(None))
+                       .order_by(Item.item_id))
+        return [{'id': item_id, 'name': label_from_labels(labels or {}, lang=lang)}
+                for item_id, labels in q]
 
     def save_items(self, items, debug=None):
         if debug is None:
@@ -762,7 +1032,7 @@ class Place(Base):
     def load_extracts_wiki(self, debug=False, progress=None, code='en'):
         wiki = code + 'wiki'
         by_title = {item.sitelinks()[wiki]['title']: item
-                    for item in self.items
+                    for item in self.items.options(undefer(Item.entity))
                     if wiki in (item.sitelinks() or {})}
 
         query_iter = wikipedia.get_extracts(by_title.keys(), code=code)
@@ -776,7 +1046,7 @@ class Place(Base):
             if progress:
                 progress(item)
 
-    def wbgetentities(self, debug=False):
+    def wbgetentities(self, debug=False, languages=None):
         sub = (session.query(Item.item_id)
                       .join(ItemTag)
                       .group_by(Item.item_id)
@@ -792,7 +1062,11 @@ class Place(Base):
         if debug:
             print('{} items'.format(len(items)))
 
-        for qid, entity in wikidata.entity_iter(items.keys(), debug=debug):
+        # items are shared between places, skip any stored entity that is current
+        stored = Item.stored_revisions(items.keys())
+        for qid, entity in wikidata.changed_entity_iter(items.keys(), stored,
+                                                        debug=debug,
+                                                        languages=languages):
             if debug:
                 print(qid)
             items[qid].entity = entity
@@ -815,20 +1089,36 @@ class Place(Base):
                       key=lambda i:i[1],
                       reverse=True)
 
+    def item_label_languages(self):
+        ''' label languages of each item, read without loading the entities '''
+        q = (self.items.with_entities(Item.item_id,
+                                      func.jsonb_object_keys(Item.entity['labels']))
+                       .filter(Item.entity.isnot(None)))
+        languages = defaultdict(set)
+        for item_id, lang in q:
+            languages[item_id].add(lang)
+        return languages
+
+    def operator_qids(self):
+        ''' P137 operators of every item, read without loading the entities '''
+        q = (self.items.with_entities(Item.entity['claims']['P137'])
+                       .filter(Item.entity['claims'].has_key('P137')))
+        return {claim['mainsnak']['datavalue']['value']['id']
+                for claims, in q for claim in claims
+                if 'datavalue' in claim['mainsnak']}
+
     def languages_wikidata(self):
         lang_count = Counter()
         item_count = self.items.count()
         count_sv = self.country_code in {'se', 'fi'}
 
-        for item in self.items:
-            if item.entity and 'labels' in item.entity:
-                keys = item.entity['labels'].keys()
-                if not count_sv and keys == {'ceb', 'sv'}:
+        for keys in self.item_label_languages().values():
+            if not count_sv and keys == {'ceb', 'sv'}:
+                continue
+            for lang in keys:
+                if '-' in lang or lang == 'ceb':
                     continue
-                for lang in keys:
-                    if '-' in lang or lang == 'ceb':
-                        continue
-                    lang_count[lang] += 1
+                lang_count[lang] += 1
 
         if item_count > 10:
             # truncate the long tail of languages
@@ -849,10 +1139,8 @@ class Place(Base):
 
     def most_common_language(self):
         lang_count = Counter()
-        for item in self.items:
-            if item.entity and 'labels' in item.entity:
-                for lang in item.entity['labels'].keys():
-                    lang_count[lang] += 1
+        for keys in self.item_label_languages().values():
+            lang_count.update(keys)
         try:
             return lang_count.most_common(1)[0][0]
         except IndexError:
@@ -877,69 +1165,170 @@ class Place(Base):
                                  PlaceItem.place == self,
                                  or_(PlaceItem.done.is_(None),
                                      PlaceItem.done != true()))
+                         .options(contains_eager(PlaceItem.item)
+                                  .undefer(Item.entity))
                          .order_by(PlaceItem.item_id))
 
-    def run_matcher(self, debug=False, progress=None):
-        if progress is None:
-            def progress(candidates, item):
-                pass
+    def find_candidates(self, place_items, stats, debug=False, incremental=False):
         conn = session.bind.raw_connection()
         cur = conn.cursor()
 
-        place_items = self.matcher_query()
-        total = place_items.count()
-        # too many items means something has gone wrong
-        assert total < 60_000
+        index = None
+        if current_app.config.get('MATCHER_SPATIAL_INDEX') and spatial_index.shapely:
+            with stats.timer('index_load'):
+                index = spatial_index.PlaceIndex.load(cur, self.prefix)
+
         for num, place_item in enumerate(place_items):
             item = place_item.item
 
+            if index is None and num % match_batch_size == 0:
+                batch = [pi.item for pi in place_items[num:num + match_batch_size]
+                         if not pi.item.skip_item_during_match()]
+                with stats.timer('batch_sql'):
+                    batch_rows = matcher.find_batch_rows(cur, batch, self.prefix)
+
             if debug:
                 print('searching for', item.label())
                 print(item.tags)
 
             if item.skip_item_during_match():
-                candidates = []
+                yield place_item, None, []
+                continue
+
+            t0 = time()
+            if index is not None:
+                with stats.timer('index_search'):
+                    rows = index.find_rows(item)
             else:
-                t0 = time()
-                candidates = matcher.find_item_matches(cur, item, self.prefix, debug=debug)
-                seconds = time() - t0
+                rows = batch_rows.get(item.item_id)
+            fingerprint = matcher.match_fingerprint(item, rows or [])
+            if incremental and fingerprint == place_item.match_fingerprint:
                 if debug:
-                    print('find_item_matches took {:.1f}'.format(seconds))
-                    print('{}: {}'.format(len(candidates), item.label()))
+                    print('unchanged:', item.label())
+                stats.count('unchanged')
+                yield place_item, fingerprint, None
+                continue
 
-            progress(candidates, item)
+            candidates = matcher.find_item_matches(cur, item, self.prefix,
+                                                   debug=debug, rows=rows,
+                                                   stats=stats)
+            seconds = time() - t0
+            if debug:
+                print('find_item_matches took {:.1f}'.format(seconds))
+                print('{}: {}'.format(len(candidates), item.label()))
 
-            # if this is a refresh we remove candidates that no longer match
-            as_set = {(i['osm_type'], i['osm_id']) for i in candidates}
-            for c in item.candidates[:]:
-                if c.edits.count():
-                    continue  # foreign keys mean we can't remove saved candidates
-                if (c.osm_type, c.osm_id) not in as_set:
-                    c.bad_matches.delete()
-                    session.delete(c)
+            yield place_item, fingerprint, candidates
 
-            if not candidates:
+        conn.close()
+
+    def find_candidates_parallel(self, place_items, stats, workers,
+                                 incremental=False, threadpool=None):
+        ''' find_candidates spread over a pool of processes
+
+        The pool is run from another thread. The websocket passes the gevent
+        hub threadpool so waiting for the workers doesn't block the hub.'''
+        config = dict(current_app.config)
+        size = min(match_batch_size,
+                   max(1, math.ceil(len(place_items) / (workers * 4))))
+        item_ids = [[pi.item_id for pi in batch]
+                    for batch in utils.chunk(place_items, size)]
+        place_item_map = {pi.item_id: pi for pi in place_items}
+        if incremental:
+            fingerprints = [{item_id: place_item_map[item_id].match_fingerprint
+                             for item_id in batch}
+                            for batch in item_ids]
+        else:
+            fingerprints = itertools.repeat(None)
+
+        results = SimpleQueue()
+        args = (self.prefix, item_ids, fingerprints, workers, config, results)
+        if threadpool is None:
+            threading.Thread(target=run_match_pool, args=args,
+                             daemon=True).start()
+            get_result = results.get
+        else:
+            threadpool.spawn(run_match_pool, *args)
+            def get_result():
+                return threadpool.apply(results.get)
+
+        while True:
+            result = get_result()
+            if result is None:
+                break
+            if isinstance(result, Exception):
+                raise result
+            worker_results, worker_stats = result
+            stats.update(worker_stats)
+            for item_id, fingerprint, candidates in worker_results:
+                yield place_item_map[item_id], fingerprint, candidates
+
+    def run_matcher(self, debug=False, progress=None, workers=None,
+                    incremental=False, threadpool=None):
+        ''' find candidates for pending items
+
+        In incremental mode items with the same Wikidata revision, tags and
+        nearby OSM objects as the last run are skipped, their candidates
+        are left in place.'''
+        if progress is None:
+            def progress(candidates, item):
+                pass
+
+        place_items = self.matcher_query().all()
+        total = len(place_items)
+        # too many items means something has gone wrong
+        assert total < 60_000
+
+        stats = matcher.MatchStats()
+        match.clear_name_forms()  # name forms are shared within a run
+
+        # no network requests from inside the candidate loop
+        with stats.timer('country_codes'):
+            embassy.fetch_country_iso_codes(self.operator_qids())
+        if workers and workers > 1 and not debug:
+            found = self.find_candidates_parallel(place_items, stats, workers,
+                                                  incremental=incremental,
+                                                  threadpool=threadpool)
+        else:
+            found = self.find_candidates(place_items, stats, debug=debug,
+                                         incremental=incremental)
+
+        to_save = []
+        for place_item, fingerprint, candidates in found:
+            item = place_item.item
+            place_item.match_fingerprint = fingerprint
+
+            if candidates is None:  # unchanged since the last run
+                existing = item.candidates.all()
+                progress(existing, item)
+                if existing:
+                    place_item.done = True
                 continue
 
-            for i in candidates:
-                c = ItemCandidate.query.get((item.item_id, i['osm_id'], i['osm_type']))
-                if c:
-                    c.update(i)
-                else:
-                    c = ItemCandidate(**i, item=item)
-                    session.add(c)
+            progress(candidates, item)
+            to_save.append((item.item_id, candidates))
+
+            if candidates:
+                place_item.done = True
+
+            if len(to_save) >= save_chunk_size:
+                with stats.timer('save'):
+                    save_candidates(to_save)
+                    session.commit()
+                to_save = []
 
-            place_item.done = True
+        if to_save:
+            with stats.timer('save'):
+                save_candidates(to_save)
 
-            if num % 100 == 0:
-                session.commit()
+        run = self.latest_matcher_run()
+        if run and not run.end:
+            run.stats = stats.as_dict()
 
         self.state = 'ready'
         self.item_count = self.items.count()
         self.candidate_count = self.items_with_candidates_count()
         session.commit()
-
-        conn.close()
+        return stats
 
     def load_isa(self):
         items = [item.qid for item in self.items_with_instanceof()]
@@ -980,6 +1369,8 @@ class Place(Base):
         if self.state == 'ready':  # already done
             return
 
+        self.ensure_geom_parts()
+
         if not self.state or self.state == 'refresh':
             print('load items')
             self.load_items()  # includes categories
@@ -1077,33 +1468,48 @@ class Place(Base):
         return add_tags
 
     def chunk_n(self, n):
-        n = max(1, n)
-        (south, north, west, east) = self.bbox
-        ns = (north - south) / n
-        ew = (east - west) / n
-
-        chunks = []
-        for row in range(n):
-            for col in range(n):
-                chunk = (south + ns * row, south + ns * (row + 1),
-                        west + ew * col, west + ew * (col + 1))
-                want_chunk = func.ST_Intersects(Place.geom, envelope(chunk))
-                want = (session.query(want_chunk)
-                               .filter(Place.place_id == self.place_id)
-                               .scalar())
-                if want:
-                    chunks.append(chunk)
-
-        return chunks
+        ''' grid cells over the bbox that intersect the place, in one query '''
+        parts = self.geom_parts()
+        cells = bbox_chunk(self.bbox, n)
+
+        grid = chunk_table(cells)
+        want_chunk = exists().where(
+            func.ST_Intersects(parts.c.geom, chunk_table_envelope(grid)))
+        want = {num for num, in session.query(grid.c.num).filter(want_chunk)}
+
+        return [chunk for num, chunk in enumerate(cells) if num in want]
+
+    def chunk_tags(self, chunks):
+        ''' tags of the items within each chunk, in one query '''
+        tags = [set() for _ in chunks]
+        if not chunks:
+            return tags
+
+        grid = chunk_table(chunks)
+        contained = cast(Item.location, Geometry).contained(chunk_table_envelope(grid))
+        q = (session.query(grid.c.num, ItemTag.tag_or_key)
+                    .select_from(Item)
+                    .join(PlaceItem, PlaceItem.item_id == Item.item_id)
+                    .join(ItemTag, ItemTag.item_id == Item.item_id)
+                    .join(grid, contained)
+                    .filter(PlaceItem.osm_type == self.osm_type,
+                            PlaceItem.osm_id == self.osm_id)
+                    .distinct())
+        for num, tag_or_key in q:
+            tags[num].add(tag_or_key)
+        return tags
 
     def get_chunks(self):
         bbox_chunks = list(self.polygon_chunk(size=place_chunk_size))
+        chunk_tags = self.chunk_tags(bbox_chunks)
 
         chunks = []
         need_self = True  # include self in first non-empty chunk
         for num, chunk in enumerate(bbox_chunks):
             filename = self.chunk_filename(num, bbox_chunks)
-            oql = self.oql_for_chunk(chunk, include_self=need_self)
+            oql = self.oql_for_chunk(chunk,
+                                     include_self=need_self,
+                                     tags=chunk_tags[num])
             chunks.append({
                 'num': num,
                 'oql': oql,
@@ -1121,6 +1527,7 @@ class Place(Base):
     def chunk(self):
         chunk_size = utils.calc_chunk_size(self.area_in_sq_km)
         chunks = self.chunk_n(chunk_size)
+        chunk_tags = self.chunk_tags(chunks)
 
         print('chunk size:', chunk_size)
 
@@ -1132,7 +1539,9 @@ class Place(Base):
             files.append(full)
             if os.path.exists(full):
                 continue
-            oql = self.oql_for_chunk(chunk, include_self=(num == 0))
+            oql = self.oql_for_chunk(chunk,
+                                     include_self=(num == 0),
+                                     tags=chunk_tags[num])
 
             r = overpass.run_query_persistent(oql)
             if not r:
@@ -1144,12 +1553,11 @@ class Place(Base):
         print(' '.join(cmd))
         subprocess.run(cmd)
 
-    def oql_for_chunk(self, chunk, include_self=False):
-        q = self.items.filter(cast(Item.location, Geometry).contained(envelope(chunk)))
+    def oql_for_chunk(self, chunk, include_self=False, tags=None):
+        if tags is None:
+            tags = self.chunk_tags([chunk])[0]
 
-        tags = set()
-        for item in q:
-            tags |= set(item.tags)
+        tags = set(tags)
         tags.difference_update(skip_tags)
         tags = matcher.simplify_tags(tags)
         if not(tags):
@@ -1170,9 +1578,10 @@ class Place(Base):
         return sum(1 for _ in self.polygon_chunk(size=place_chunk_size))
 
     def geojson_chunks(self):
+        display_geom = func.coalesce(Place.display_geom, cast(Place.geom, Geometry))
         chunks = []
         for chunk in self.polygon_chunk(size=place_chunk_size):
-            clip = func.ST_Intersection(Place.geom, envelope(chunk))
+            clip = func.ST_Intersection(display_geom, envelope(chunk))
 
             geojson = (session.query(func.ST_AsGeoJSON(clip, 4))
                               .filter(Place.place_id == self.place_id)
@@ -1181,6 +1590,25 @@ class Place(Base):
             chunks.append(geojson)
         return chunks
 
+    def known_item_count(self):
+        ''' items already in the database that are within this place '''
+        parts = self.geom_parts()
+        covers = func.ST_Covers(cast(parts.c.geom, Geography), Item.location)
+        return (session.query(func.count(Item.item_id.distinct()))
+                       .join(parts, covers)
+                       .scalar())
+
+    def wikidata_tile_size(self):
+        ''' side in km of the first wikidata query tiles
+
+        Items loaded for overlapping places give the density, without them
+        use the fixed size and split any tiles that time out.'''
+        known = self.known_item_count()
+        if not known:
+            return place_chunk_size
+        side = math.sqrt(wikidata_tile_items * self.area_in_sq_km / known)
+        return min(max(side, wikidata_tile_min), wikidata_tile_max)
+
     def wikidata_chunk_size(self):
         if self.osm_type == 'node':
             return 1
@@ -1231,7 +1659,7 @@ class Place(Base):
             out['geom'] = json.loads(self.geojson)
 
         items = []
-        for item in self.items:
+        for item in self.items.options(undefer(Item.entity)):
             if not item.sitelinks():
                 continue
             cur = {
@@ -1303,6 +1731,16 @@ class Place(Base):
         return ret
 
 
+class PlaceGeomPart(Base):
+    ''' piece of a place geometry split with ST_Subdivide '''
+    __tablename__ = 'place_geom_part'
+    part_id = Column(Integer, primary_key=True)
+    place_id = Column(BigInteger,
+                      ForeignKey('place.place_id', ondelete='CASCADE'),
+                      nullable=False,
+                      index=True)
+    geom = Column(Geometry(srid=4326, spatial_index=True), nullable=False)
+
 class PlaceMatcher(Base):
     __tablename__ = 'place_matcher'
     start = Column(DateTime, default=now_utc(), primary_key=True)
@@ -1313,6 +1751,7 @@ class PlaceMatcher(Base):
     user_id = Column(Integer, ForeignKey('user.id'))
     user_agent = Column(String)
     is_refresh = Column(Boolean, nullable=False)
+    stats = Column(postgresql.JSON)  # time spent in each matcher stage
 
     place = relationship('Place', uselist=False,
                          backref=backref('matcher_runs',
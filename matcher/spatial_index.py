@@ -0,0 +1,115 @@
+'''In-memory alternative to the PostGIS candidate search.
+
+Loads the OSM objects for a place once and answers the same questions as
+item_match_sql and nearby_nodes_sql using an STRtree. Needs shapely 2.'''
+
+from . import matcher
+import math
+
+try:
+    import shapely
+    import shapely.wkt
+    from shapely.strtree import STRtree
+except ImportError:
+    shapely = None
+
+earth_radius = 6378137  # metres, as used by EPSG:3857
+
+def web_mercator(lon, lat):
+    x = math.radians(lon) * earth_radius
+    y = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * earth_radius
+    return x, y
+
+def item_point(item):
+    ewkt = item.ewkt
+    if ewkt.startswith('SRID='):
+        ewkt = ewkt.partition(';')[2]
+    point = shapely.wkt.loads(ewkt)
+    return shapely.Point(*web_mercator(point.x, point.y))
+
+def tags_match(tags, osm_tags):
+    '''Python version of the hstore_query test'''
+    for tag in tags:
+        if '=' not in tag:
+            if tag in osm_tags:
+                return True
+            continue
+        k, v = tag.split('=')
+        if k not in osm_tags:
+            continue
+        values = osm_tags[k].split(';')
+        if v in values or v.replace('_', ' ') in values:
+            return True
+    return False
+
+class PlaceIndex:
+    def __init__(self, rows):
+        self.src_type = []
+        self.osm_id = []
+        self.name = []
+        self.tags = []
+        wkb = []
+        for src_type, osm_id, name, tags, way in rows:
+            self.src_type.append(src_type)
+            self.osm_id.append(osm_id)
+            self.name.append(name)
+            self.tags.append(tags)
+            wkb.append(bytes(way))
+        self.geoms = shapely.from_wkb(wkb)
+        self.tree = STRtree(self.geoms)
+
+    @classmethod
+    def load(cls, cur, prefix):
+        sql = ' union all '.join(f"select '{obj_type}', osm_id, name, tags, "
+                                 f'ST_AsBinary(way) from {prefix}_{obj_type}'
+                                 for obj_type in ('point', 'line', 'polygon'))
+        cur.execute(sql)
+        return cls(cur.fetchall())
+
+    def __len__(self):
+        return len(self.osm_id)
+
+    def within(self, point, max_dist, src_types=None):
+        '''(dist, index) for objects within max_dist of point, nearest first'''
+        found = self.tree.query(point, predicate='dwithin', distance=max_dist)
+        if src_types:
+            found = [i for i in found if self.src_type[i] in src_types]
+        dists = shapely.distance(point, self.geoms[found])
+        return sorted(zip(dists.tolist(), found))
+
+    def row(self, num, dist):
+        return (self.src_type[num], self.osm_id[num], self.name[num],
+                self.tags[num], dist)
+
+    def item_match_rows(self, item, ignore_tags=None, limit=50):
+        tags = item.calculate_tags(ignore_tags=ignore_tags)
+        if not tags:
+            return []
+        max_dist = (matcher.get_max_dist_from_criteria(item.tags) or
+                    matcher.default_max_dist)
+
+        rows = []
+        seen = set()
+        for dist, num in self.within(item_point(item), max_dist * 1000):
+            if not tags_match(tags, self.tags[num]):
+                continue
+            # SQL union drops duplicate rows
+            key = (self.src_type[num], self.osm_id[num], self.name[num], dist)
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append(self.row(num, dist))
+            if len(rows) == limit:
+                break
+        return rows
+
+    def nearby_node_rows(self, item, max_dist=10):
+        found = self.within(item_point(item), max_dist, src_types={'point'})
+        return [self.row(num, dist) for dist, num in found]
+
+    def find_rows(self, item):
+        '''rows for find_item_matches, same as the SQL candidate search'''
+        profile = matcher.get_match_profile(item)
+        ignore_tags = {'building'} if profile.is_a_historic_district else set()
+        return (self.item_match_rows(item, ignore_tags=ignore_tags) +
+                self.nearby_node_rows(item))
@@ -14,7 +14,7 @@ from lxml import etree
 from social.apps.flask_app.routes import social_auth
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.orm.exc import MultipleResultsFound
-from sqlalchemy.orm import load_only
+from sqlalchemy.orm import load_only, undefer
 from sqlalchemy import func, distinct
 from werkzeug.exceptions import InternalServerError
 from geopy.distance import distance
@@ -366,7 +366,8 @@ def add_tags(osm_type, osm_id):
     g.country_code = place.country_code
 
     include = request.form.getlist('include')
-    items = Item.query.filter(Item.item_id.in_([i[1:] for i in include])).all()
+    items = (Item.query.options(undefer(Item.entity))
+                       .filter(Item.item_id.in_([i[1:] for i in include])).all())
 
     languages_with_counts = get_place_language_with_counts(place)
     languages = [l['lang'] for l in languages_with_counts if l['lang']]
@@ -499,7 +500,8 @@ def candidates(osm_type, osm_id):
         if not item_ids:
             items = Item.query.filter(0 == 1)
         else:
-            items = Item.query.filter(Item.item_id.in_(item_ids))
+            items = (Item.query.options(undefer(Item.entity))
+                               .filter(Item.item_id.in_(item_ids)))
     else:
         items = place.items_with_candidates()
 
@@ -1187,7 +1189,7 @@ def tag_page(tag_or_key):
               .group_by(Item.item_id)
               .subquery())
 
-    q = Item.query.filter(Item.item_id == sub.c.item_id)
+    q = Item.query.options(undefer(Item.entity)).filter(Item.item_id == sub.c.item_id)
 
     return render_template('tag_page.html', tag_or_key=tag_or_key, q=q)
 
@@ -1477,6 +1479,7 @@ def single_item_match(osm_type, osm_id, item_id):
     conn = database.session.bind.raw_connection()
     cur = conn.cursor()
 
+    matcher.prefetch_mission_countries([item])
     candidates = matcher.find_item_matches(cur, item, place.prefix, debug=False)
 
     for c in candidates:
@@ -1,13 +1,16 @@
 from flask import Blueprint, current_app, g
 from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from .place import Place, bbox_chunk
 from . import wikipedia, database, wikidata, netstring, utils, edit, mail
 from flask_login import current_user
-from .model import ItemCandidate, ChangesetEdit
+from .model import Item, ItemCandidate, ChangesetEdit
 from datetime import datetime
 from lxml import etree
 from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm import undefer
 import requests
+import gevent
 import re
 import json
 import socket
@@ -17,6 +20,8 @@ import shutil
 
 ws = Blueprint('ws', __name__)
 re_point = re.compile(r'^Point\(([-E0-9.]+) ([-E0-9.]+)\)$')
+# tiles in progress, wikidata.query_slots limits the SPARQL queries in flight
+wikidata_tile_workers = 2
 
 # TODO: different coloured icons
 # - has enwiki article
@@ -31,6 +36,7 @@ class MatcherSocket(object):
         self.socket = socket
         self.place = place
         self.t0 = time()
+        self.pins_sent = set()
 
         start = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
         self.log_filename = '{}_{}.log'.format(place.place_id, start)
@@ -76,22 +82,61 @@ class MatcherSocket(object):
         self.send('already_done')
         # FIXME - send error mail
 
+    def stream_pins(self, items):
+        self.send('pins', pins=build_item_list(items))
+        self.pins_sent.update(items.keys())
+
     def wikidata_chunked(self, chunks):
+        ''' query the tiles in parallel, a tile that times out is split in four
+
+        Pins for each tile are sent as soon as the tile arrives.'''
+        app = current_app._get_current_object()
+        place = self.place
         items = {}
+        pending = {}
         num = 0
-        while chunks:
-            bbox = chunks.pop()
+
+        def fetch(bbox):
+            with app.app_context():
+                return place.items_from_wikidata(wikidata.bbox_query_map(*bbox))
+
+        def submit(bbox):
+            nonlocal num
             num += 1
             msg = f'requesting wikidata chunk {num}'
             print(msg)
             self.status(msg)
-            try:
-                items.update(self.place.bbox_wikidata_items(bbox))
-            except wikidata.QueryTimeout:
-                msg = f'wikidata timeout, splitting chunk {num} info four'
-                print(msg)
-                self.status(msg)
-                chunks += bbox_chunk(bbox, 2)
+            pending[executor.submit(fetch, bbox)] = (num, bbox)
+
+        executor = ThreadPoolExecutor(max_workers=wikidata_tile_workers)
+        try:
+            for bbox in chunks:
+                submit(bbox)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_num, bbox = pending.pop(future)
+                    try:
+                        tile_items = future.result()
+                    except wikidata.QueryTimeout:
+                        msg = f'wikidata timeout, splitting chunk {chunk_num} into four'
+                        print(msg)
+                        self.status(msg)
+                        for sub_bbox in bbox_chunk(bbox, 2):
+                            submit(sub_bbox)
+                        continue
+
+                    # database access stays in this thread
+                    new_items = {qid: v for qid, v in tile_items.items()
+                                 if qid not in items}
+                    covered = place.covered_qids(new_items)
+                    found = {qid: v for qid, v in new_items.items()
+                             if qid in covered}
+                    items.update(found)
+                    if found:
+                        self.stream_pins(found)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
         return items
 
@@ -110,7 +155,7 @@ class MatcherSocket(object):
                 self.status(msg)
 
         if chunk_size != 1:
-            chunks = list(place.polygon_chunk(size=32))
+            chunks = list(place.polygon_chunk(size=place.wikidata_tile_size()))
 
             msg = f'downloading wikidata in {len(chunks)} chunks'
             self.status(msg)
@@ -132,7 +177,9 @@ class MatcherSocket(object):
 
         self.status('wikidata query complete')
         print('done')
-        pins = build_item_list(wikidata_items)
+        # pins for chunked downloads have already been sent
+        pins = build_item_list({qid: v for qid, v in wikidata_items.items()
+                                if qid not in self.pins_sent})
         print('send pins: ', len(pins))
         self.send('pins', pins=pins)
         print('sent')
@@ -233,7 +280,10 @@ class MatcherSocket(object):
 
         print('getting wikidata item details')
         self.status('getting wikidata item details')
-        for qid, entity in wikidata.entity_iter(db_items.keys()):
+        stored = {qid: (item.entity['lastrevid'], item.entity.get('profile'))
+                  for qid, item in db_items.items()
+                  if item.entity and 'lastrevid' in item.entity}
+        for qid, entity in wikidata.changed_entity_iter(db_items.keys(), stored):
             item = db_items[qid]
             item.entity = entity
             msg = 'load entity: ' + item.label_and_qid()
@@ -263,7 +313,13 @@ class MatcherSocket(object):
             msg = item.label_and_qid() + count
             self.item_line(msg)
 
-        self.place.run_matcher(progress=progress)
+        # the process pool is driven from the hub threadpool, waiting for
+        # results in a greenlet would block the other connections
+        config = current_app.config
+        self.place.run_matcher(progress=progress,
+                               workers=config.get('MATCHER_WORKERS'),
+                               incremental=config.get('MATCHER_INCREMENTAL'),
+                               threadpool=gevent.get_hub().threadpool)
 
 def build_item_list(items):
     item_list = []
@@ -285,7 +341,7 @@ def build_item_list(items):
 def get_pins(place):
     ''' Build pins from items in database. '''
     pins = []
-    for item in place.items:
+    for item in place.items.options(undefer(Item.entity)):
         lat, lon = item.coords()
         pin = {
             'qid': item.qid,
@@ -326,6 +382,7 @@ def run_matcher(place, m):
         return m.already_done()
 
     print('state:', place.state)
+    place.ensure_geom_parts()
 
     if not place.state or place.state == 'refresh':
         print('get items')
@@ -342,7 +399,8 @@ def run_matcher(place, m):
         pins = get_pins(place)
         m.send('pins', pins=pins)
 
-    db_items = {item.qid: item for item in place.items}
+    db_items = {item.qid: item
+                for item in place.items.options(undefer(Item.entity))}
     item_count = len(db_items)
     m.status('{:,d} Wikidata items found'.format(item_count))
 
@@ -1,11 +1,14 @@
-from flask import render_template_string, render_template
+from flask import render_template_string, render_template, current_app, has_app_context
 from urllib.parse import unquote
 from collections import defaultdict
 from .utils import chunk, drop_start, cache_filename
 from .language import get_language_label
 from . import user_agent_headers, overpass, mail, language, match, matcher
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+import requests.adapters
 import requests.exceptions
+import threading
 import os
 import json
 import simplejson.errors
@@ -13,6 +16,21 @@ import time
 import re
 
 page_size = 50
+wikidata_api_url = 'https://www.wikidata.org/w/api.php'
+entity_workers = 4  # parallel wbgetentities requests, Wikimedia asks for few
+entity_timeout = 60
+entity_attempts = 5
+entity_backoff = 1  # seconds, doubled after each failed attempt
+retry_status_codes = {429, 500, 502, 503, 504}
+query_workers = 4  # parallel SPARQL queries for one place
+# WDQS allows five concurrent queries per IP, shared by every query we run
+max_running_queries = 4
+query_slots = threading.BoundedSemaphore(max_running_queries)
+entity_session = None  # shared by the entity_executor threads, see get_session
+entity_executor = None
+entity_lock = threading.Lock()
+# props requested for the matcher, descriptions are never read
+entity_props = ['info', 'labels', 'aliases', 'sitelinks', 'claims']
 report_missing_values = False
 wd_entity = 'http://www.wikidata.org/entity/Q'
 enwiki = 'https://en.wikipedia.org/wiki/'
@@ -578,10 +596,14 @@ def run_query(query, name=None, return_json=True, timeout=None, send_error_mail=
 
     for attempt in range(attempts):
         try:  # retry if we get a ChunkedEncodingError
-            r = requests.post(wikidata_query_api_url,
-                              data={'query': query, 'format': 'json'},
-                              timeout=timeout,
-                              headers=user_agent_headers())
+            with query_slots:
+                r = requests.post(wikidata_query_api_url,
+                                  data={'query': query, 'format': 'json'},
+                                  timeout=timeout,
+                                  headers=user_agent_headers())
+            if r.status_code == 429 and attempt < attempts - 1:
+                time.sleep(retry_delay(attempt, r))  # throttled, try again
+                continue
             if r.status_code != 200:
                 break
             if name:
@@ -606,6 +628,31 @@ def run_query(query, name=None, return_json=True, timeout=None, send_error_mail=
     error_mail('wikidata query error', r)
     raise QueryError(query, r)
 
+def run_queries(queries, workers=None):
+    ''' run named SPARQL queries in parallel
+
+    Returns {name: rows}, a query that failed has its QueryError as the value.'''
+    app = current_app._get_current_object() if has_app_context() else None
+
+    def run(query):
+        if app is None:
+            return run_query(query)
+        with app.app_context():  # error mails need the config
+            return run_query(query)
+
+    workers = min(workers or query_workers, len(queries)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(run, query)
+                   for name, query in queries.items()}
+
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except QueryError as e:
+            results[name] = e
+    return results
+
 def flatten_criteria(items):
     start = {'Tag:' + i[4:] + '=' for i in items if i.startswith('Key:')}
     return {i for i in items if not any(i.startswith(s) for s in start)}
@@ -662,33 +709,139 @@ def parse_item_tag_query(rows, items):
                     items[qid][k] = row[k]['value']
         items[qid]['tags'].add(tag_or_key)
 
-def entity_iter(ids, debug=False):
-    attempts = 5
-
-    wikidata_url = 'https://www.wikidata.org/w/api.php'
+def get_session():
+    ''' keep-alive session for wbgetentities, with a connection for each
+    entity_executor thread that stays open between calls '''
+    global entity_session
+    with entity_lock:
+        if entity_session is None:
+            session = requests.Session()
+            session.headers.update(user_agent_headers())
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=entity_workers)
+            session.mount('https://', adapter)
+            entity_session = session
+    return entity_session
+
+def get_entity_executor():
+    ''' threads for wbgetentities requests, shared by every entity_iter call
+    so no more than entity_workers requests run at once '''
+    global entity_executor
+    with entity_lock:
+        if entity_executor is None:
+            entity_executor = ThreadPoolExecutor(max_workers=entity_workers,
+                                                 thread_name_prefix='wbgetentities')
+    return entity_executor
+
+def retry_delay(attempt, r=None):
+    ''' seconds to wait before trying again, uses Retry-After if given '''
+    retry_after = r.headers.get('Retry-After') if r is not None else None
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return entity_backoff * 2 ** attempt
+
+def fetch_entity_page(ids, props=None, languages=None):
+    ''' wbgetentities for up to page_size IDs, with retries '''
     params = {
         'format': 'json',
         'formatversion': 2,
         'action': 'wbgetentities',
+        'ids': '|'.join(ids),
     }
-    for num, cur in enumerate(chunk(ids, page_size)):
-        if debug:
-            print('entity_iter: {}/{}'.format(num * page_size, len(ids)))
-        params['ids'] = '|'.join(cur)
-        for attempt in range(attempts):
-            try:
-                r = requests.get(wikidata_url,
-                                 params=params,
-                                 headers=user_agent_headers())
-                break
-            except requests.exceptions.ChunkedEncodingError:
-                if attempt == attempts - 1:
-                    raise
-                time.sleep(1)
+    if props:
+        params['props'] = props
+    if languages:
+        params['languages'] = languages
+    for attempt in range(entity_attempts):
+        last_attempt = attempt == entity_attempts - 1
+        try:
+            r = get_session().get(wikidata_api_url,
+                                  params=params,
+                                  timeout=entity_timeout)
+        except (requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if last_attempt:
+                raise
+            time.sleep(retry_delay(attempt))
+            continue
+        if r.status_code in retry_status_codes and not last_attempt:
+            time.sleep(retry_delay(attempt, r))
+            continue
         r.raise_for_status()
-        json_data = r.json()
-        for qid, entity in json_data['entities'].items():
-            yield qid, entity
+        return r.json()['entities']
+
+def entity_iter(ids, debug=False, ordered=False, props=None, languages=None):
+    ''' yield (qid, entity) for the IDs, pages are fetched in parallel
+
+    Pages are yielded as they arrive, or in the order of ids with ordered.'''
+    pages = list(chunk(ids, page_size))
+    if not pages:
+        return
+
+    executor = get_entity_executor()
+    futures = [executor.submit(fetch_entity_page, page, props, languages)
+               for page in pages]
+    try:
+        done = futures if ordered else as_completed(futures)
+        for num, future in enumerate(done):
+            if debug:
+                print('entity_iter: {}/{}'.format(num * page_size, len(ids)))
+            yield from future.result().items()
+    finally:
+        for future in futures:  # pages not needed after an early exit
+            future.cancel()
+
+def entity_revisions(ids):
+    ''' current revision of each entity, from a cheap props=info request '''
+    return {qid: entity.get('lastrevid')
+            for qid, entity in entity_iter(ids, props='info')}
+
+def entity_profile(languages=None):
+    ''' name of the download profile, recorded in each entity fetched with it '''
+    if not languages:
+        return 'match'
+    return 'match:' + '|'.join(sorted(set(languages) | {'en'}))
+
+def profile_covers(stored, wanted):
+    ''' does an entity fetched with the stored profile have what wanted needs '''
+    if stored == wanted or stored == 'match':
+        return True
+    if not stored or wanted == 'match':
+        return False
+    return set(wanted[6:].split('|')) <= set(stored[6:].split('|'))
+
+def profile_entity_iter(ids, languages=None, debug=False):
+    ''' entity_iter that downloads only what the matcher reads
+
+    Descriptions are skipped and labels and aliases are limited to languages,
+    English is always included. Sitelinks aren't filtered by language so the
+    names from sitelinks are all there. '''
+    profile = entity_profile(languages)
+    params = {'props': '|'.join(entity_props)}
+    if languages:
+        params['languages'] = profile[6:]
+    for qid, entity in entity_iter(ids, debug=debug, **params):
+        entity['profile'] = profile
+        yield qid, entity
+
+def changed_entity_iter(ids, stored_revisions, debug=False, languages=None):
+    ''' profile_entity_iter that skips entities with a stored copy that is current
+
+    stored_revisions maps QID to (lastrevid, profile) of the copy we already
+    have, a copy fetched with a narrower profile is fetched again.'''
+    ids = list(ids)
+    wanted = entity_profile(languages)
+    known = [qid for qid in ids
+             if qid in stored_revisions and stored_revisions[qid][0] and
+             profile_covers(stored_revisions[qid][1], wanted)]
+    current = entity_revisions(known) if known else {}
+    fetch = [qid for qid in ids
+             if qid not in current or current[qid] != stored_revisions[qid][0]]
+    if debug:
+        print('entities: {} current, {} to fetch'.format(len(ids) - len(fetch),
+                                                         len(fetch)))
+    yield from profile_entity_iter(fetch, languages=languages, debug=debug)
 
 def get_entity(qid):
     wikidata_url = 'https://www.wikidata.org/w/api.php'
@@ -714,7 +867,7 @@ def entity_label(entity):
     else:  # pick a label at random
         return list(entity['labels'].values())[0]['value']
 
-def get_entities(ids):
+def get_entities(ids, props=None):
     if not ids:
         return []
     if len(ids) > 50:
@@ -726,6 +879,8 @@ def get_entities(ids):
         'action': 'wbgetentities',
         'ids': '|'.join(ids),
     }
+    if props:
+        params['props'] = props
     attempts = 5
     for attempt in range(attempts):
         try:  # retry if we get a ChunkedEncodingError
@@ -740,6 +895,32 @@ def get_entities(ids):
             if attempt == attempts - 1:
                 raise QueryError(params, r)
 
+# parts of an entity that the matcher and views read, the rest is dropped
+# before storing: descriptions, references, qualifiers and statement IDs
+entity_keys = {'id', 'type', 'missing', 'lastrevid', 'modified', 'profile',
+               'labels', 'aliases', 'sitelinks', 'claims'}
+snak_keys = {'snaktype', 'property', 'datavalue'}
+
+def slim_claim(claim):
+    slim = {'mainsnak': {k: v for k, v in claim['mainsnak'].items()
+                         if k in snak_keys}}
+    if 'rank' in claim:
+        slim['rank'] = claim['rank']
+    return slim
+
+def slim_entity(entity):
+    ''' entity without the fields we never read, safe to call more than once '''
+    if not entity:
+        return entity
+    slim = {k: v for k, v in entity.items() if k in entity_keys}
+    if 'claims' in slim:
+        slim['claims'] = {pid: [slim_claim(c) for c in claims]
+                          for pid, claims in slim['claims'].items()}
+    if 'sitelinks' in slim:
+        slim['sitelinks'] = {key: {k: v for k, v in link.items() if k != 'badges'}
+                             for key, link in slim['sitelinks'].items()}
+    return slim
+
 def names_from_entity(entity, skip_lang=None):
     if not entity or 'labels' not in entity:
         return
@@ -1231,7 +1412,7 @@ class WikidataItem:
         # is in more than 50 locations. The maximum entities in one request is 50.
         if len(located_in) > 50:
             return
-        for location in get_entities(located_in):
+        for location in get_entities(located_in, props='labels'):
             if 'labels' not in location:
                 continue
             location_names |= {v['value']
@@ -41,3 +41,25 @@ def app(request, postgresql):
     yield app
 
     ctx.pop()
+
+@pytest.fixture
+def osm_tables(app):
+    ''' create and fill point, line and polygon tables like osm2pgsql
+
+    Call with the table prefix and (obj_type, osm_id, name, tags, wkt) rows,
+    tags in hstore format and WKT in WGS84.'''
+    def load(prefix, osm):
+        conn = database.session.bind.raw_connection()
+        cur = conn.cursor()
+        cur.execute('create extension if not exists hstore')
+        for obj_type in 'point', 'line', 'polygon':
+            cur.execute(f'create table {prefix}_{obj_type} (osm_id bigint, '
+                        'name text, tags hstore, way geometry(Geometry, 3857))')
+        for obj_type, osm_id, name, tags, wkt in osm:
+            cur.execute(f'insert into {prefix}_{obj_type} values (%s, %s, '
+                        "%s::hstore, ST_Transform(ST_GeomFromEWKT(%s), 3857))",
+                        (osm_id, name, tags, 'SRID=4326;' + wkt))
+        conn.commit()
+        conn.close()
+
+    return load
@@ -0,0 +1,54 @@
+from matcher import benchmark, matcher
+import os.path
+
+class MockApp:
+    config = {'DATA_DIR': os.path.normpath(os.path.split(__file__)[0] + '/../data')}
+
+test_case = {
+    'qid': 'Q1',
+    'entity': {
+        'claims': {},
+        'labels': {'en': {'language': 'en', 'value': 'The Castle Inn'}},
+        'sitelinks': {},
+    },
+    'tags': ['amenity=pub'],
+    'categories': ['Pubs in London'],
+    'extract': '<p>The Castle Inn is a pub on Castle Street.</p>',
+    'extract_names': [],
+    'ewkt': 'SRID=4326;POINT(0 51.5)',
+    'isa': [{'item_id': 212198, 'label': 'pub',
+             'entity': {'labels': {'en': {'language': 'en', 'value': 'pub'}}}}],
+    'places': [{'place_id': 1,
+                'address': [{'type': 'city', 'name': 'London'},
+                            {'type': 'country_code', 'name': 'gb'}]}],
+    'rows': [['point', 1, 'Castle Inn', {'name': 'Castle Inn', 'amenity': 'pub'}, 5]],
+}
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert benchmark.percentile(values, 50) == 50
+    assert benchmark.percentile(values, 99) == 99
+    assert benchmark.percentile(values, 100) == 100
+    assert benchmark.percentile([], 50) == 0
+
+def test_build_item(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    item = benchmark.build_item(test_case)
+    assert item.extract == test_case['extract']
+    assert item.place_names() == {'London'}
+    assert 'pub' in item.more_endings_from_isa()
+
+    case = benchmark.record_item(item, test_case['rows'])
+    assert dict(case, qid='Q1') == test_case  # qid is set by the database
+
+def test_run(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    results = benchmark.run([test_case], repeat=2)
+    assert set(results) == set(benchmark.benchmarks)
+    assert results['find_item_matches']['calls'] == 2
+    assert results['name_match']['calls'] == 2
+    for result in results.values():
+        assert result['p50'] <= result['p90'] <= result['p99'] <= result['max']
+
+    changes = benchmark.compare(results, results)
+    assert changes['name_match']['p50'] == 0
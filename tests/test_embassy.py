@@ -0,0 +1,55 @@
+from matcher import embassy
+import json
+
+def test_from_name():
+    assert embassy.from_name('Embassy of Canada')['qid'] == 'Q16'
+    assert embassy.from_name('Consulate General of Switzerland in San Francisco')['alpha2'] == 'CH'
+    assert embassy.from_name('Swedish Embassy')['alpha2'] == 'SE'
+    assert embassy.from_name("Ambassade d'Irlande") is None
+    assert embassy.from_name("Ambassade de l'Italie")['alpha2'] == 'IT'
+    assert embassy.from_name('UNITED STATES EMBASSY')['alpha2'] == 'US'
+    assert embassy.from_name('Irelands Embassy')['alpha2'] == 'IE'
+    assert embassy.from_name('Canadaville') is None
+    assert embassy.from_name('') is None
+
+def test_longest_name_first():
+    assert embassy.from_name('Embassy of the United States of Mexico')['alpha2'] == 'MX'
+    assert embassy.from_name('Embassy of South Africa')['alpha2'] == 'ZA'
+
+def test_from_names():
+    found = embassy.from_names(['Embassy of Japan', 'Library', None, 'Embassy of Japan'])
+    assert set(found) == {'Embassy of Japan', 'Library'}
+    assert found['Embassy of Japan']['alpha2'] == 'JP'
+    assert found['Library'] is None
+
+def test_country_iso_codes():
+    assert embassy.country_iso_codes('Q145') == ['GB', 'GBR']
+    assert embassy.country_iso_codes('Q458') == ['EU']
+    assert embassy.iso_codes_for_countries(['Q16', 'Q17']) == {'CA', 'CAN', 'JP', 'JPN'}
+    assert embassy.iso_codes_for_countries(['Q16', 'Q1']) is None
+    assert embassy.country_iso_codes('Q1') is None
+
+def test_fetch_country_iso_codes(monkeypatch, tmp_path):
+    requested = []
+
+    def mock_get_entities(ids, props=None):
+        requested.append(ids)
+        code = {'mainsnak': {'datavalue': {'value': 'FD'}}}
+        return [{'id': 'Q99999999', 'claims': {'P297': [code]}},
+                {'id': 'Q42', 'claims': {}}]  # an operator, not a country
+
+    filename = tmp_path / 'country_iso_codes.json'
+    monkeypatch.setattr(embassy.wikidata, 'get_entities', mock_get_entities)
+    monkeypatch.setattr(embassy, 'iso_codes', dict(embassy.iso_codes))
+    monkeypatch.setattr(embassy, 'iso_codes_cache_loaded', True)
+    monkeypatch.setattr(embassy, 'iso_codes_cache_filename', lambda: str(filename))
+
+    embassy.fetch_country_iso_codes({'Q16', 'Q801'})
+    assert requested == []  # seeded countries need no request
+
+    embassy.fetch_country_iso_codes({'Q16', 'Q42', 'Q99999999'})
+    assert requested == [['Q42', 'Q99999999']]
+    assert embassy.country_iso_codes('Q99999999') == ['FD']
+    assert embassy.country_iso_codes('Q42') == []
+    assert json.load(open(filename)) == {'Q42': [], 'Q99999999': ['FD']}
+    assert [p.name for p in tmp_path.iterdir()] == ['country_iso_codes.json']
@@ -82,6 +82,34 @@ def test_normalize_name():
     assert match.normalize_name('TEST TEST') == 'testtest'
     assert match.normalize_name('testtest') == 'testtest'
 
+def test_name_forms():
+    match.clear_name_forms()
+    forms = match.name_forms("The Saint Andrew's Church")
+    assert match.name_forms("The Saint Andrew's Church") is forms
+    assert forms.lc == "the saint andrew's church"
+    assert forms.tidy1 == match.tidy_name(forms.lc)
+    assert forms.tidy == match.drop_article(match.strip_words(forms.tidy1))
+    assert forms.normalized == match.normalize_name(forms.name)
+    assert match.name_forms.cache_info().currsize == 1
+
+    match.clear_name_forms()
+    assert match.name_forms.cache_info().currsize == 0
+
+def test_name_pairs_to_check():
+    wikidata_names = ['Castle Inn', 'This Is A Test', 'Green House Farm',
+                      'Zamek', 'Bridge at Somewhere']
+    osm_names = ['The Castle', 'TIAT', 'Greenfarm', 'Unrelated']
+    pairs = match.name_pairs_to_check(osm_names, wikidata_names, {'house'})
+
+    assert ('The Castle', 'Castle Inn') in pairs
+    assert ('Greenfarm', 'Green House Farm') in pairs
+    assert ('Unrelated', 'Castle Inn') not in pairs
+    assert ('The Castle', 'Zamek') not in pairs
+    # could be initials, compared with every name
+    assert all(('TIAT', w) in pairs for w in wikidata_names)
+    # ' at ' names are always compared
+    assert ('Unrelated', 'Bridge at Somewhere') in pairs
+
 def test_has_address():
     assert not match.has_address({})
     assert match.has_address({'addr:full': '1 Station Road'})
@@ -1,6 +1,8 @@
-from matcher import matcher
+from matcher import matcher, embassy, database
 from matcher.model import Item, IsA, ItemCandidate
+from matcher.place import Place
 import os.path
+import json
 
 class MockApp:
     config = {'DATA_DIR': os.path.normpath(os.path.split(__file__)[0] + '/../data')}
@@ -12,6 +14,9 @@ class MockDatabase:
     def fetchone(self):
         pass
 
+    def fetchall(self):
+        return []
+
 entity = {
   "claims": {
     "P17": [
@@ -167,11 +172,200 @@ def test_simplify_tags():
 def test_item_match_sql(monkeypatch):
     item = Item(entity=entity, tags=['building'])
     monkeypatch.setattr(matcher, 'current_app', MockApp)
-    sql = matcher.item_match_sql(item, 'test')
-    assert "(tags ? 'building')" in sql
+    sql, params = matcher.item_match_sql(item, 'test')
+    assert '(tags ?| %(only_keys)s)' in sql
+    assert 'building' in params['only_keys']
+    assert params['ewkt'] == item.ewkt
+
+def test_hstore_query():
+    sql, params = matcher.hstore_query(['building', 'amenity=place_of_worship'])
+    assert sql.startswith('(tags ?| %(keys)s) and ')
+    assert params['keys'] == ['amenity', 'building']
+    assert params['only_keys'] == ['building']
+    assert params['k0'] == 'amenity'
+    assert params['v0'] == 'place_of_worship'
+    assert params['s0'] == 'place of worship'
+
+def test_batch_match_sql():
+    sql = matcher.batch_match_sql('test')
+    assert 'from test_polygon' in sql
+    assert 'cross join lateral' in sql
+    assert sql.endswith('order by item_id, part, dist')
+
+def test_batch_match_item(monkeypatch):
+    item = Item(item_id=1, entity=entity, tags=['building'])
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    item_id, ewkt, max_dist, tags, keys = matcher.batch_match_item(item)
+    assert item_id == 1
+    assert max_dist == matcher.default_max_dist
+    assert 'building' in tags
+    assert tags == sorted(tags)
+    assert 'building' in keys
+
+def test_find_item_matches_with_batch_rows(monkeypatch):
+    def mock_run_sql(cur, sql, params=None, debug=False):
+        assert False  # rows from find_batch_rows, no query needed
+
+    monkeypatch.setattr(matcher, 'run_sql', mock_run_sql)
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+
+    osm_tags = {'name': 'Baryshnikov Arts Center', 'building': 'yes'}
+    item = Item(entity=entity, tags=['building'])
+    rows = [('polygon', 1, 'Baryshnikov Arts Center', osm_tags, 0.0)]
+    assert matcher.find_item_matches(MockDatabase(), item, 'prefix', rows=[]) == []
+    candidates = matcher.find_item_matches(MockDatabase(), item, 'prefix',
+                                           rows=rows)
+    assert [c['osm_id'] for c in candidates] == [1]
+
+def test_candidate_geom_sql():
+    candidates = [
+        {'planet_table': 'polygon', 'src_id': -2},
+        {'planet_table': 'point', 'src_id': 1},
+        {'planet_table': 'polygon', 'src_id': 3},
+    ]
+    sql = matcher.candidate_geom_sql(candidates, 'test')
+    assert sql.count(' union all ') == 1
+    assert 'from test_point where osm_id in (1)' in sql
+    assert 'from test_polygon where osm_id in (-2, 3)' in sql
+
+def test_category_classifier(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    monkeypatch.setattr(matcher, 'category_classifier', None)
+
+    cats = ['Church of England church buildings in Suffolk', 'People from Suffolk']
+    tags = matcher.categories_to_tags(cats)
+    assert 'amenity=place_of_worship' in tags
+
+    classifier = matcher.get_category_classifier()
+    assert matcher.get_category_classifier() is classifier
+    assert set(classifier.cache) == set(cats)
+    assert classifier.cache['People from Suffolk'] == frozenset()
+
+    tag_map = matcher.categories_to_tags_map(cats)
+    assert list(tag_map) == [cats[0]]
+    assert tag_map[cats[0]] == set(tags)
+
+def test_entity_types_reload(monkeypatch, tmp_path):
+    class TmpApp:
+        config = {'DATA_DIR': str(tmp_path)}
+    monkeypatch.setattr(matcher, 'current_app', TmpApp)
+    monkeypatch.setattr(matcher, 'entity_types', None)
+    monkeypatch.setattr(matcher, 'entity_types_check_interval', 0)
+
+    filename = tmp_path / 'entity_types.json'
+    types = [{'cats': [], 'tags': ['amenity=pub'], 'trim': ['pub'], 'dist': 1},
+             {'cats': [], 'tags': ['amenity=pub', 'building'], 'trim': ['inn'],
+              'dist': 2, 'check_housename': True, 'wikidata': 'Q1'}]
+    filename.write_text(json.dumps(types))
+    os.utime(filename, (1, 1))
+
+    assert matcher.get_ending_from_criteria(['amenity=pub']) == {'pub', 'inn'}
+    assert matcher.get_max_dist_from_criteria(['amenity=pub']) == 2
+    assert matcher.could_be_building({'amenity=pub'}, ['Q1'])
+    registry = matcher.get_entity_types()
+
+    types[1]['trim'] = ['tavern']
+    filename.write_text(json.dumps(types))
+    os.utime(filename, (2, 2))
+
+    assert matcher.get_ending_from_criteria(['amenity=pub']) == {'pub', 'tavern'}
+    assert matcher.get_entity_types() is not registry
+
+def test_get_match_profile(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    monkeypatch.setattr(matcher, 'match_profiles', {})
+
+    def load_item(**kwargs):  # as loaded by a later request or matcher run
+        return Item(item_id=4866042, tags=['building'], **kwargs)
+
+    item = load_item(entity=dict(entity, lastrevid=1))
+    profile = matcher.get_match_profile(item)
+    assert 'Baryshnikov Arts Center' in profile.names
+    assert profile.instanceof == {'Q3469910'}
+    assert matcher.get_match_profile(item) is profile
+    # kept between matcher runs and shared with the views
+    assert matcher.get_match_profile(load_item(entity=dict(entity, lastrevid=1))) is profile
+
+    item.entity = dict(entity, lastrevid=2)
+    assert matcher.get_match_profile(item) is not profile
+
+    place = Place(place_id=1, address=[{'type': 'city', 'name': 'New York'}])
+    item = load_item(entity=dict(entity, lastrevid=2))
+    item.places.append(place)
+    assert matcher.get_match_profile(item).place_names == {'New York'}
+
+    place.address = [{'type': 'city', 'name': 'Manhattan'}]
+    item = load_item(entity=dict(entity, lastrevid=2))
+    item.places.append(place)
+    assert matcher.get_match_profile(item).place_names == {'Manhattan'}
+
+    isa = IsA(item_id=3469910,
+              entity={'lastrevid': 1,
+                      'labels': {'en': {'language': 'en',
+                                        'value': 'performing arts center'}}})
+    item = load_item(entity=dict(entity, lastrevid=2), isa=[isa])
+    assert 'performing arts center' in matcher.get_match_profile(item).endings
+
+    isa.entity = dict(isa.entity, lastrevid=2,
+                      labels={'en': {'language': 'en', 'value': 'arts venue'}})
+    item = load_item(entity=dict(entity, lastrevid=2), isa=[isa])
+    assert 'arts venue' in matcher.get_match_profile(item).endings
+
+    unsaved = Item(entity=entity, tags=['building'])
+    assert matcher.get_match_profile(unsaved) is not matcher.get_match_profile(unsaved)
+
+def test_match_fingerprint(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    item = Item(item_id=4866042, entity=dict(entity, lastrevid=1),
+                tags=['building'])
+    rows = [('polygon', 1, 'Test', {'building': 'yes'}, 0.0),
+            ('point', 2, None, {'amenity': 'cafe'}, 5.0)]
+    fingerprint = matcher.match_fingerprint(item, rows)
+    assert matcher.match_fingerprint(item, rows[::-1]) == fingerprint
+
+    rows[1][3]['name'] = 'Test Cafe'
+    assert matcher.match_fingerprint(item, rows) != fingerprint
+    changed = matcher.match_fingerprint(item, rows)
+
+    item.entity = dict(entity, lastrevid=2)
+    assert matcher.match_fingerprint(item, rows) != changed
+    changed = matcher.match_fingerprint(item, rows)
+
+    # the address in extract check reads it
+    item.extract = '<p>At 450 West 37th Street.</p>'
+    assert matcher.match_fingerprint(item, rows) != changed
+    changed = matcher.match_fingerprint(item, rows)
+
+    monkeypatch.setattr(matcher, 'MATCHER_VERSION', matcher.MATCHER_VERSION + 1)
+    assert matcher.match_fingerprint(item, rows) != changed
+    changed = matcher.match_fingerprint(item, rows)
+
+    monkeypatch.setattr(matcher, 'entity_types', matcher.EntityTypes([]))
+    assert matcher.match_fingerprint(item, rows) != changed
+
+def test_find_item_matches_stats(monkeypatch):
+    def mock_run_sql(cur, sql, params=None, debug=False):
+        if not sql.startswith('select * from'):
+            return []
+        osm_tags = {'name': 'Baryshnikov Arts Center', 'building': 'yes'}
+        return [('polygon', 1, 'Baryshnikov Arts Center', osm_tags, 0.0)]
+
+    monkeypatch.setattr(matcher, 'run_sql', mock_run_sql)
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+
+    item = Item(entity=entity, tags=['building'])
+    stats = matcher.MatchStats()
+    candidates = matcher.find_item_matches(MockDatabase(), item, 'prefix',
+                                           stats=stats)
+    assert len(candidates) == 1
+
+    result = stats.as_dict()
+    assert result['counts'] == {'items': 1, 'rows': 1, 'candidates': 1}
+    for stage in 'tag_sql', 'nearby_sql', 'name_match', 'rules', 'geom':
+        assert stage in result['seconds']
 
 def find_item_matches(monkeypatch, osm_tags, item):
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [('node', 1, None, osm_tags, 0)]
@@ -230,7 +424,7 @@ def test_church_is_not_school(monkeypatch):
         'denomination': 'catholic',
     }
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [('polygon', 1, None, osm_tags, 0)]
@@ -262,7 +456,7 @@ def test_match_operator_at_start_of_name(monkeypatch):
     tags = ['highway=services']
     item = Item(entity=test_entity, tags=tags)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [('polygon', 64002602, None, osm_tags, 0)]
@@ -308,7 +502,7 @@ def test_find_item_matches_parking(monkeypatch):
     tags = ['amenity=arts_centre', 'building']
     item = Item(entity=test_entity, tags=tags)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [('polygon', 116620439, None, osm_tags, 253.7)]
@@ -369,7 +563,7 @@ def test_embassy_no_match(monkeypatch):
     tags = ['amenity=embassy']
     item = Item(entity=test_entity, tags=tags, extract=extract)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [('point', 1, None, osm_tags1, 0),
@@ -383,6 +577,58 @@ def test_embassy_no_match(monkeypatch):
     candidates = matcher.find_item_matches(mock_db, item, 'prefix')
     assert len(candidates) == 0
 
+def test_embassy_country_prefetched(monkeypatch, tmp_path):
+    osm_tags = {
+        'name': 'Embassy of Freedonia',
+        'building': 'yes',
+        'country': 'DE',
+    }
+    test_entity = {
+        'claims': {
+            'P137': [{
+                'mainsnak': {'datavalue': {'value': {'id': 'Q99999999'}}},
+            }],
+        },
+        'labels': {'en': {'language': 'en', 'value': 'Embassy of Freedonia'}},
+        'sitelinks': {},
+    }
+    # not tagged as a diplomatic mission, the operator is still prefetched
+    item = Item(item_id=1, entity=test_entity, tags=['building'])
+    assert matcher.diplomatic_mission_countries([item]) == {'Q99999999'}
+
+    fetched = []
+
+    def mock_get_entities(ids, props=None):
+        fetched.extend(ids)
+        codes = [{'mainsnak': {'datavalue': {'value': 'FD'}}}]
+        return [{'id': qid, 'claims': {'P297': codes}} for qid in ids]
+
+    def mock_run_sql(cur, sql, params=None, debug=False):
+        if not sql.startswith('select * from'):
+            return []
+        return [('polygon', 1, None, osm_tags, 0)]
+
+    monkeypatch.setattr(matcher, 'run_sql', mock_run_sql)
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    monkeypatch.setattr(embassy, 'iso_codes', dict(embassy.iso_codes))
+    monkeypatch.setattr(embassy, 'iso_codes_cache_loaded', True)
+    monkeypatch.setattr(embassy, 'iso_codes_cache_filename',
+                        lambda: str(tmp_path / 'country_iso_codes.json'))
+    monkeypatch.setattr(embassy.wikidata, 'get_entities', mock_get_entities)
+
+    osm_tags['country'] = 'FD'
+    # unknown operator, the country can't be confirmed and nothing is fetched
+    assert matcher.find_item_matches(MockDatabase(), item, 'prefix') == []
+    assert fetched == []
+
+    matcher.prefetch_mission_countries([item])
+    assert fetched == ['Q99999999']
+    assert len(matcher.find_item_matches(MockDatabase(), item, 'prefix')) == 1
+
+    osm_tags['country'] = 'DE'
+    assert matcher.find_item_matches(MockDatabase(), item, 'prefix') == []
+    assert fetched == ['Q99999999']
+
 def test_find_item_matches_pub(monkeypatch):
     osm_tags = {
         'amenity': 'university',
@@ -399,7 +645,7 @@ def test_find_item_matches_pub(monkeypatch):
     tags = ['building', 'amenity=pub']
     item = Item(entity=test_entity, tags=tags)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         return [('polygon', -295355, None, osm_tags, 12.75)]
 
     monkeypatch.setattr(matcher, 'run_sql', mock_run_sql)
@@ -420,7 +666,7 @@ def test_find_item_matches(monkeypatch):
         'addr:housenumber': '450',
     }
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [('polygon', 265273006, None, osm_tags, 0.0)]
@@ -475,7 +721,7 @@ def test_name_and_location_better_than_address_and_building(monkeypatch):
     tags = ['man_made=tower', 'building=tower', 'height']
     item = Item(entity=test_entity, tags=tags, extract=extract)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if sql.startswith('select * from'):
             return [('polygon', 29191381, None, hotel_tags, 0)]
         else:
@@ -520,7 +766,7 @@ def test_alcatraz_lighthouse(monkeypatch):
     tags = ['tourism=attraction', 'building', 'man_made=lighthouse']
     item = Item(entity=test_entity, tags=tags)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [
@@ -675,7 +921,7 @@ def test_cottage_church_bad_match(monkeypatch):
     tags = ['building', 'building=yes']
     item = Item(entity=entity, tags=tags, isa=[isa])
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [
@@ -711,7 +957,7 @@ def test_lifeboat_station_church_bad_match(monkeypatch):
             'emergency=lifeboat_station']
     item = Item(entity=entity, tags=tags)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [
@@ -746,7 +992,7 @@ def test_castle_station_bad_match(monkeypatch):
     tags = ['historic=castle', 'building']
     item = Item(entity=entity, tags=tags)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [
@@ -799,7 +1045,7 @@ def test_church_pub_bad_match(monkeypatch):
         return ['West Sussex']
     monkeypatch.setattr(item, 'place_names', place_names)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [
@@ -854,7 +1100,7 @@ def test_railway_station_cafe_bad_match(monkeypatch):
     tags = ['building=train_station', 'railway=station', 'railway=halt']
     item = Item(entity=entity, tags=tags)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [
@@ -892,7 +1138,7 @@ def test_prefer_tag_match_over_building_only_match(monkeypatch):
     tags = ['building=train_station', 'railway=station', 'building']
     item = Item(entity=entity, tags=tags)
 
-    def mock_run_sql(cur, sql, debug):
+    def mock_run_sql(cur, sql, params=None, debug=False):
         if not sql.startswith('select * from'):
             return []
         return [
@@ -1119,3 +1365,60 @@ def test_school_shouldnt_match_church(monkeypatch):
 
     ret = matcher.check_item_candidate(candidate)
     assert 'reject' in ret
+
+def test_find_batch_rows_same_as_item_match_sql(app, osm_tables):
+    osm = [
+        ('point', 1, 'Central Library', 'amenity=>library', 'POINT(-2.6205 51.4541)'),
+        ('point', 2, 'Corner Shop', 'shop=>convenience', 'POINT(-2.62072 51.45401)'),
+        ('point', 3, 'Far Library', 'amenity=>library', 'POINT(-2.5 51.5)'),
+        ('point', 4, 'Art Gallery', 'tourism=>"museum;gallery"', 'POINT(-2.6215 51.4545)'),
+        ('line', 5, 'High Street', 'highway=>primary', 'LINESTRING(-2.63 51.45, -2.61 51.46)'),
+        ('polygon', 6, 'City Museum', 'tourism=>museum, building=>yes',
+         'POLYGON((-2.6220 51.4535, -2.6210 51.4535, -2.6210 51.4545, '
+         '-2.6220 51.4545, -2.6220 51.4535))'),
+        ('polygon', 7, 'Old Hall', 'historic=>"city hall", building=>yes',
+         'POLYGON((-2.6200 51.4535, -2.6195 51.4535, -2.6195 51.4540, '
+         '-2.6200 51.4540, -2.6200 51.4535))'),
+    ]
+    osm_tables('batch_test', osm)
+
+    def entity(label):
+        return {'labels': {'en': {'language': 'en', 'value': label}},
+                'claims': {}}
+
+    items = [
+        Item(item_id=201, location='Point(-2.62071 51.454)',
+             tags={'amenity=library'}, entity=entity('Central Library')),
+        Item(item_id=202, location='Point(-2.6212 51.4542)',
+             tags={'tourism=museum', 'tourism=gallery'},
+             entity=entity('City Museum')),
+        Item(item_id=203, location='Point(-2.61975 51.45375)',
+             tags={'historic=city_hall'}, entity=entity('Old Hall')),
+        Item(item_id=204, location='Point(-2.62071 51.454)',
+             entity=entity('Corner Shop')),  # no tags, only nearby nodes
+    ]
+    database.session.add_all(items)
+    database.session.commit()
+
+    conn = database.session.bind.raw_connection()
+    cur = conn.cursor()
+    batch = matcher.find_batch_rows(cur, items, 'batch_test')
+    assert set(batch) == {201, 202, 203, 204}
+
+    for item in items:
+        query = matcher.item_match_sql(item, 'batch_test')
+        rows = matcher.run_sql(cur, *query) if query else []
+        nearby = matcher.run_sql(cur, *matcher.nearby_nodes_sql(item, 'batch_test'))
+        rows += sorted(nearby, key=lambda row: row[4])
+        assert batch[item.item_id] == rows
+
+    def osm_ids(item_id):
+        return {(row[0], row[1]) for row in batch[item_id]}
+
+    assert ('point', 1) in osm_ids(201)
+    assert ('point', 3) not in osm_ids(201)  # too far away
+    assert {('point', 4), ('polygon', 6)} <= osm_ids(202)
+    assert ('polygon', 7) in osm_ids(203)  # city_hall matches 'city hall'
+    assert osm_ids(204) == {('point', 2)}
+
+    conn.close()
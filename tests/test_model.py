@@ -1,4 +1,4 @@
-from matcher.model import Item
+from matcher.model import Item, label_from_labels
 from matcher import matcher
 import os.path
 
@@ -63,3 +63,12 @@ def test_calculate_tags(monkeypatch):
     result = item.calculate_tags()
     assert 'building' not in result
     assert result == tags | {'leisure=park'}
+
+def test_label_from_labels():
+    labels = {'fr': {'language': 'fr', 'value': 'Tour Eiffel'},
+              'de': {'language': 'de', 'value': 'Eiffelturm'}}
+    assert label_from_labels(labels, lang='fr') == 'Tour Eiffel'
+    # no English label, the same fallback whatever order the keys come in
+    assert label_from_labels(labels) == 'Eiffelturm'
+    assert label_from_labels(dict(reversed(list(labels.items())))) == 'Eiffelturm'
+    assert label_from_labels({}) is None
@@ -1,6 +1,12 @@
-from matcher.model import Item
-from matcher.place import Place
-from matcher import database
+from matcher.model import (Item, ItemCandidate, BadMatch, User, Changeset,
+                           ChangesetEdit)
+from matcher.place import (Place, PlaceItem, PlaceGeomPart, save_candidates,
+                           upsert_candidates, bbox_chunk, envelope)
+from sqlalchemy import func, cast
+from geoalchemy2 import Geography, Geometry
+from matcher import database, spatial_index
+from concurrent.futures import ThreadPoolExecutor
+import matcher.place
 
 def simple_place():
     place = Place(place_id=1,
@@ -60,3 +66,342 @@ def test_place_country_code(app):
                      'country_code': 'us'}
     assert place.country_code == 'us'
     assert place.get_address_key('missing key') is None
+
+def candidate(osm_id, **kwargs):
+    c = {'osm_type': 'node',
+         'osm_id': osm_id,
+         'name': f'node {osm_id}',
+         'dist': 10.0,
+         'tags': {'amenity': 'library'},
+         'planet_table': 'point',
+         'src_id': osm_id,
+         'geom': 'SRID=4326;POINT(-2.62071 51.454)',
+         'identifier_match': False,
+         'address_match': None,
+         'name_match': {'name': [['good', 'test', [['name', 'name']]]]},
+         'matching_tags': {'amenity=library'}}  # not a column, dropped on save
+    c.update(kwargs)
+    return c
+
+def add_items(*item_ids):
+    items = [Item(item_id=item_id, location='Point(-2.62071 51.454)')
+             for item_id in item_ids]
+    database.session.add_all(items)
+    database.session.commit()
+    return items
+
+def saved_candidates(item_ids):
+    q = (ItemCandidate.query.filter(ItemCandidate.item_id.in_(item_ids))
+                            .order_by(ItemCandidate.item_id, ItemCandidate.osm_id))
+    return [(c.item_id, c.osm_id) for c in q]
+
+def test_save_candidates_refresh(app):
+    add_items(101, 102, 103)
+    user = User(id=101, username='test')
+    database.session.add(user)
+    database.session.commit()
+
+    save_candidates([(101, [candidate(1), candidate(2), candidate(3)]),
+                     (102, [candidate(4)]),
+                     (103, [candidate(5)])])
+    database.session.add(BadMatch(item_id=101, osm_id=2, osm_type='node',
+                                  user=user))
+    database.session.commit()
+    assert saved_candidates([101, 102, 103]) == [(101, 1), (101, 2), (101, 3),
+                                                 (102, 4), (103, 5)]
+
+    # refresh 101 and 102: node 1 still matches, nodes 2 and 3 are gone,
+    # item 102 has no candidates left and item 103 isn't part of the refresh
+    save_candidates([(101, [candidate(1, dist=5.0), candidate(6)]),
+                     (102, [])])
+    database.session.commit()
+    assert saved_candidates([101, 102, 103]) == [(101, 1), (101, 6), (103, 5)]
+    assert ItemCandidate.query.get((101, 1, 'node')).dist == 5.0
+    assert BadMatch.query.filter_by(item_id=101).count() == 0
+
+def test_save_candidates_keeps_edited(app):
+    place = Place(place_id=104, osm_type='way', osm_id=104,
+                  display_name='edited place', category='test', type='test',
+                  place_rank=1, south=0, west=0, north=0, east=0)
+    user = User(id=104, username='editor')
+    database.session.add_all([place, user])
+    add_items(104)
+
+    save_candidates([(104, [candidate(1), candidate(2)])])
+    changeset = Changeset(id=104, place_id=104, osm_type='way', osm_id=104,
+                          item_id=104, user=user, update_count=1)
+    database.session.add(changeset)
+    database.session.add(ChangesetEdit(changeset=changeset, item_id=104,
+                                       osm_id=2, osm_type='node'))
+    database.session.commit()
+
+    # node 2 no longer matches, but it has been saved to OSM
+    save_candidates([(104, [candidate(1)])])
+    database.session.commit()
+    assert saved_candidates([104]) == [(104, 1), (104, 2)]
+
+def test_upsert_candidates_different_keys(app):
+    add_items(105)
+    upsert_candidates([dict(candidate(1, name='old name'), item_id=105)])
+    database.session.commit()
+
+    # nrhp matches don't have geom or name_match, existing values are kept
+    nrhp = {'item_id': 105, 'osm_type': 'node', 'osm_id': 1,
+            'name': 'new name', 'dist': 1.0, 'tags': {'ref:nrhp': '1'},
+            'planet_table': 'point', 'src_id': 1, 'identifier_match': True}
+    upsert_candidates([nrhp,
+                       dict(candidate(2), item_id=105),
+                       dict(nrhp, osm_id=3, src_id=3)])
+    database.session.commit()
+
+    c = ItemCandidate.query.get((105, 1, 'node'))
+    assert c.name == 'new name'
+    assert c.identifier_match
+    assert c.geom is not None
+    assert c.name_match == candidate(1)['name_match']
+
+    c = ItemCandidate.query.get((105, 3, 'node'))
+    assert c.geom is None and c.name_match is None
+    assert saved_candidates([105]) == [(105, 1), (105, 2), (105, 3)]
+
+def test_run_matcher_save_chunks(app, monkeypatch):
+    place = Place(place_id=106, osm_type='way', osm_id=106,
+                  display_name='chunk place', category='test', type='test',
+                  place_rank=1, south=0, west=0, north=0, east=0)
+    item_ids = list(range(106, 111))
+    for item_id in item_ids:
+        place.items.append(Item(item_id=item_id,
+                                location='Point(-2.62071 51.454)',
+                                entity={'id': f'Q{item_id}', 'claims': {}}))
+    database.session.add(place)
+    database.session.commit()
+
+    # item 108 has no candidates, the others have one each
+    def find_candidates(self, place_items, stats, debug=False, incremental=False):
+        for place_item in place_items:
+            item_id = place_item.item_id
+            yield place_item, None, [] if item_id == 108 else [candidate(item_id)]
+
+    chunks = []
+
+    def save(found):
+        chunks.append([item_id for item_id, candidates in found])
+        save_candidates(found)
+
+    monkeypatch.setattr(Place, 'find_candidates', find_candidates)
+    monkeypatch.setattr(matcher.place, 'save_chunk_size', 2)
+    monkeypatch.setattr(matcher.place, 'save_candidates', save)
+
+    place.run_matcher()
+
+    assert chunks == [[106, 107], [108, 109], [110]]
+    assert saved_candidates(item_ids) == [(i, i) for i in item_ids if i != 108]
+    done = {pi.item_id: pi.done
+            for pi in PlaceItem.query.filter_by(osm_type='way', osm_id=106)}
+    assert done == {106: True, 107: True, 108: None, 109: True, 110: True}
+    assert place.candidate_count == 4
+
+def l_shaped_place(monkeypatch):
+    ''' place along the south and west edges of its bbox, with items '''
+    # small pieces so the place is split into more than one part
+    monkeypatch.setattr(matcher.place, 'subdivide_max_vertices', 5)
+    place = Place.query.get(300)
+    if place:
+        return place
+
+    place = Place(place_id=300, osm_type='relation', osm_id=300,
+                  display_name='l-shaped place', category='boundary',
+                  type='administrative', place_rank=16,
+                  south=50, west=0, north=51, east=1,
+                  geom='SRID=4326;POLYGON((0 50, 1 50, 1 50.25, 0.25 50.25, '
+                       '0.25 51, 0 51, 0 50))')
+    items = [(301, 'Point(0.1 50.1)', {'amenity=library'}),
+             (302, 'Point(0.6 50.1)', {'tourism=museum', 'building'}),
+             (303, 'Point(0.1 50.8)', {'historic=castle'}),
+             (304, 'Point(0.6 50.8)', {'shop=bakery'})]  # outside the L
+    for item_id, location, tags in items:
+        place.items.append(Item(item_id=item_id, location=location, tags=tags))
+    database.session.add(place)
+    database.session.flush()
+    place.build_geom_parts()
+    database.session.commit()
+    assert PlaceGeomPart.query.filter_by(place_id=300).count() > 1
+    return place
+
+def geom_parts_states(place):
+    ''' run the checks with the stored parts, then the fallback to the
+    whole geometry used for places without parts '''
+    yield 'stored'
+    place.clear_geom_parts()
+    database.session.commit()
+    yield 'whole geometry'
+    place.build_geom_parts()
+    database.session.commit()
+
+def place_geom():
+    return cast(Place.geom, Geometry)
+
+def test_chunk_n_and_chunk_tags(app, monkeypatch):
+    place = l_shaped_place(monkeypatch)
+
+    def chunk_n_per_cell(n):
+        return [chunk for chunk in bbox_chunk(place.bbox, n)
+                if (database.session.query(func.ST_Intersects(place_geom(),
+                                                              envelope(chunk)))
+                                    .filter(Place.place_id == place.place_id)
+                                    .scalar())]
+
+    def chunk_tags_per_chunk(chunks):
+        tags = []
+        for chunk in chunks:
+            contained = cast(Item.location, Geometry).contained(envelope(chunk))
+            tags.append({tag for item in place.items.filter(contained)
+                         for tag in item.tags})
+        return tags
+
+    for state in geom_parts_states(place):
+        for n in 1, 2, 4, 5:
+            chunks = place.chunk_n(n)
+            assert chunks == chunk_n_per_cell(n), (state, n)
+        assert len(place.chunk_n(4)) < 16
+
+        chunks = bbox_chunk(place.bbox, 4)
+        assert place.chunk_tags(chunks) == chunk_tags_per_chunk(chunks)
+        assert place.chunk_tags(chunks)[0] == {'amenity=library'}
+        assert place.chunk_tags([]) == []
+
+def test_covered_qids_and_known_item_count(app, monkeypatch):
+    place = l_shaped_place(monkeypatch)
+    items = {'Q301': {'location': 'Point(0.1 50.1)'},
+             'Q302': {'location': 'Point(0.6 50.1)'},
+             'Q303': {'location': 'Point(0.1 50.8)'},
+             'Q304': {'location': 'Point(0.6 50.8)'},
+             'Q305': {'location': 'Point(1.5 50.1)'},  # outside the bbox
+             'Q306': {'location': 'Point(0.25 50.5)'}}  # on the boundary
+
+    def covers_per_item(item):
+        point = func.ST_GeomFromText(item['location'], 4326)
+        return (database.session.query(func.ST_Covers(place_geom(), point))
+                                .filter(Place.place_id == place.place_id)
+                                .scalar())
+
+    def known_items_per_item():
+        covered = func.ST_Covers(cast(Place.geom, Geography), Item.location)
+        return (Item.query.join(Place, covered)
+                          .filter(Place.place_id == place.place_id)
+                          .count())
+
+    expect = {qid for qid, item in items.items() if covers_per_item(item)}
+    assert expect == {'Q301', 'Q302', 'Q303', 'Q306'}
+
+    for state in geom_parts_states(place):
+        assert place.covered_qids(items) == expect, state
+        assert {qid for qid, item in items.items()
+                if place.covers(item)} == expect, state
+        assert place.known_item_count() == known_items_per_item() == 3, state
+    assert place.covered_qids({}) == set()
+
+class ThreadPool:
+    ''' the parts of the gevent hub threadpool the matcher uses '''
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def spawn(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def apply(self, func, args=()):
+        return self.executor.submit(func, *args).result()
+
+def test_find_candidates_parallel_same_as_serial(app, monkeypatch, osm_tables):
+    place = Place(place_id=400, osm_type='relation', osm_id=400,
+                  display_name='parallel place', category='boundary',
+                  type='administrative', place_rank=16,
+                  south=51.45, west=-2.63, north=51.46, east=-2.61)
+
+    osm = [('point', 1, 'Central Library',
+            'name=>"Central Library", amenity=>library', 'POINT(-2.6205 51.4541)'),
+           ('point', 2, 'Art Gallery',
+            'name=>"Art Gallery", tourism=>gallery', 'POINT(-2.6215 51.4545)'),
+           ('polygon', 3, 'City Museum',
+            'name=>"City Museum", tourism=>museum, building=>yes',
+            'POLYGON((-2.6220 51.4535, -2.6210 51.4535, -2.6210 51.4545, '
+            '-2.6220 51.4545, -2.6220 51.4535))')]
+    osm_tables(place.prefix, osm)
+
+    items = [(401, 'Point(-2.62071 51.454)', {'amenity=library'}, 'Central Library'),
+             (402, 'Point(-2.6212 51.4542)', {'tourism=museum'}, 'City Museum'),
+             (403, 'Point(-2.6214 51.4544)', {'tourism=gallery'}, 'Art Gallery'),
+             (404, 'Point(-2.6214 51.4544)', {'tourism=gallery'}, 'Old Gallery'),
+             (405, 'Point(-2.615 51.455)', {'amenity=library'}, 'Branch Library')]
+    for item_id, location, tags, label in items:
+        entity = {'labels': {'en': {'language': 'en', 'value': label}},
+                  'claims': {}}
+        place.items.append(Item(item_id=item_id, location=location,
+                                tags=tags, entity=entity))
+    database.session.add(place)
+    database.session.commit()
+
+    place_items = place.matcher_query().all()
+    assert len(place_items) == len(items)
+
+    def results(found):
+        return [(place_item.item_id, fingerprint, candidates)
+                for place_item, fingerprint, candidates in found]
+
+    stats = matcher.matcher.MatchStats()
+    serial = results(place.find_candidates(place_items, stats))
+    parallel = results(place.find_candidates_parallel(place_items, stats, 2))
+    assert parallel == serial
+    assert any(candidates for item_id, fingerprint, candidates in serial)
+
+    # as run from the websocket
+    parallel = results(place.find_candidates_parallel(place_items, stats, 2,
+                                                      threadpool=ThreadPool()))
+    assert parallel == serial
+
+    if spatial_index.shapely:
+        monkeypatch.setitem(app.config, 'MATCHER_SPATIAL_INDEX', True)
+        parallel = results(place.find_candidates_parallel(place_items, stats, 2))
+        assert parallel == serial
+
+    # nothing has changed, so an incremental run skips every item
+    for place_item, (item_id, fingerprint, candidates) in zip(place_items, serial):
+        place_item.match_fingerprint = fingerprint
+    parallel = results(place.find_candidates_parallel(place_items, stats, 2,
+                                                      incremental=True))
+    assert parallel == [(item_id, fingerprint, None)
+                        for item_id, fingerprint, candidates in serial]
+
+def test_geom_parts_rebuilt_when_geometry_changes(app, monkeypatch):
+    place = l_shaped_place(monkeypatch)
+    geotext = ('POLYGON((0 50, 1 50, 1 50.25, 0.25 50.25, '
+               '0.25 51, 0 51, 0 50))')
+    hit = {'place_id': 300, 'lat': 50.5, 'lon': 0.5,
+           'display_name': 'l-shaped place', 'place_rank': 16,
+           'category': 'boundary', 'type': 'administrative', 'icon': None,
+           'extratags': {}, 'namedetails': {},
+           'boundingbox': [50, 51, 0, 1], 'address': {'county': 'Test'},
+           'geotext': geotext}
+
+    def part_count():
+        return PlaceGeomPart.query.filter_by(place_id=300).count()
+
+    parts = part_count()
+    place.update_from_nominatim(hit)
+    database.session.commit()
+    assert part_count() == parts  # same geometry, parts kept
+
+    hit['geotext'] = 'POLYGON((0 50, 1 50, 1 51, 0 51, 0 50))'
+    place.update_from_nominatim(hit)
+    database.session.commit()
+    assert part_count() == 0
+    assert place.display_geom is None
+
+    place.ensure_geom_parts()  # first match of the new geometry
+    assert part_count() >= 1
+    assert place.covered_qids({'Q304': {'location': 'Point(0.6 50.8)'}}) == {'Q304'}
+
+    hit['geotext'] = geotext
+    place.update_from_nominatim(hit)
+    place.ensure_geom_parts()
+    assert part_count() == parts
@@ -0,0 +1,59 @@
+import pytest
+from matcher import matcher, spatial_index
+from matcher.model import Item
+import os.path
+
+shapely = pytest.importorskip('shapely')
+
+class MockApp:
+    config = {'DATA_DIR': os.path.normpath(os.path.split(__file__)[0] + '/../data')}
+
+test_entity = {
+    'claims': {},
+    'labels': {'en': {'language': 'en', 'value': 'The Castle Inn'}},
+    'sitelinks': {},
+}
+
+def osm_row(src_type, osm_id, name, tags, lon, lat, size=0):
+    x, y = spatial_index.web_mercator(lon, lat)
+    geom = shapely.Point(x, y)
+    if size:
+        geom = geom.buffer(size)
+    return (src_type, osm_id, name, tags, shapely.to_wkb(geom))
+
+def test_web_mercator():
+    assert spatial_index.web_mercator(0, 0) == pytest.approx((0, 0), abs=1e-6)
+    x, y = spatial_index.web_mercator(180, 0)
+    assert x == pytest.approx(20037508.34, abs=0.01)
+
+def test_tags_match():
+    assert spatial_index.tags_match(['building'], {'building': 'yes'})
+    assert spatial_index.tags_match(['amenity=pub'], {'amenity': 'cafe;pub'})
+    assert spatial_index.tags_match(['amenity=place_of_worship'],
+                                    {'amenity': 'place of worship'})
+    assert not spatial_index.tags_match(['amenity=pub'], {'shop': 'pub'})
+
+def test_find_rows(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    rows = [
+        osm_row('polygon', 1, 'Castle Inn', {'amenity': 'pub'}, 0, 51.5, size=20),
+        osm_row('point', 2, 'Castle Inn', {'amenity': 'pub'}, 0.001, 51.5),
+        osm_row('point', 3, 'Castle Cafe', {'amenity': 'cafe'}, 0, 51.5),
+        osm_row('point', 4, 'Castle Inn', {'amenity': 'pub'}, 1, 51.5),
+    ]
+    index = spatial_index.PlaceIndex(rows)
+    assert len(index) == 4
+
+    item = Item(entity=test_entity, tags=['amenity=pub'],
+                ewkt='SRID=4326;POINT(0 51.5)')
+    found = index.find_rows(item)
+    assert [(src_type, osm_id) for src_type, osm_id, *rest in found] == [
+        ('polygon', 1), ('point', 2), ('point', 3)]
+    assert found[0][4] == 0
+
+def test_item_point():
+    point = spatial_index.item_point(Item(ewkt='SRID=4326;POINT(0 51.5)'))
+    assert (point.x, point.y) == spatial_index.web_mercator(0, 51.5)
+
+    point = spatial_index.item_point(Item(ewkt='POINT(1e-05 -3.5e-07)'))
+    assert (point.x, point.y) == spatial_index.web_mercator(1e-05, -3.5e-07)
@@ -524,3 +524,138 @@ def test_parse_enwiki_query():
     }
 
     assert wikidata.parse_enwiki_query(rows) == expect
+
+def test_entity_iter(monkeypatch):
+    def mock_fetch(ids, props=None, languages=None):
+        return {qid: {'id': qid} for qid in ids}
+
+    monkeypatch.setattr(wikidata, 'fetch_entity_page', mock_fetch)
+    ids = ['Q{}'.format(i) for i in range(1, 121)]
+
+    found = list(wikidata.entity_iter(ids, ordered=True))
+    assert [qid for qid, entity in found] == ids
+
+    found = dict(wikidata.entity_iter(ids))
+    assert set(found) == set(ids)
+
+    # stopping early leaves the shared executor usable
+    first = next(wikidata.entity_iter(ids, ordered=True))
+    assert first[0] == 'Q1'
+    assert len(dict(wikidata.entity_iter(ids))) == len(ids)
+    assert list(wikidata.entity_iter([])) == []
+
+def test_changed_entity_iter(monkeypatch):
+    requests = []
+
+    def mock_fetch(ids, props=None, languages=None):
+        requests.append((props, sorted(ids)))
+        return {qid: {'id': qid, 'lastrevid': 2} for qid in ids}
+
+    monkeypatch.setattr(wikidata, 'fetch_entity_page', mock_fetch)
+    stored = {'Q1': (2, 'match'), 'Q2': (1, 'match'), 'Q4': (2, 'match:en')}
+    ids = ['Q1', 'Q2', 'Q3', 'Q4']
+    found = dict(wikidata.changed_entity_iter(ids, stored))
+    assert set(found) == {'Q2', 'Q3', 'Q4'}
+    assert found['Q3']['profile'] == 'match'
+    props = '|'.join(wikidata.entity_props)
+    assert requests == [('info', ['Q1', 'Q2']), (props, ['Q2', 'Q3', 'Q4'])]
+
+def test_profile_covers():
+    assert wikidata.entity_profile(['fr', 'de']) == 'match:de|en|fr'
+    assert wikidata.profile_covers('match', 'match:en|fr')
+    assert wikidata.profile_covers('match:de|en|fr', 'match:en|fr')
+    assert not wikidata.profile_covers('match:en', 'match:en|fr')
+    assert not wikidata.profile_covers('match:en', 'match')
+    assert not wikidata.profile_covers(None, 'match')
+
+def test_fetch_entity_page_retry(monkeypatch):
+    class Response:
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.headers = {}
+
+        def raise_for_status(self):
+            assert self.status_code == 200
+
+        def json(self):
+            return {'entities': {'Q1': {'id': 'Q1'}}}
+
+    responses = [Response(503), Response(200)]
+
+    class Session:
+        def get(self, url, params, timeout):
+            assert params['ids'] == 'Q1'
+            assert timeout == wikidata.entity_timeout
+            return responses.pop(0)
+
+    monkeypatch.setattr(wikidata, 'get_session', Session)
+    monkeypatch.setattr(wikidata.time, 'sleep', lambda seconds: None)
+    assert wikidata.fetch_entity_page(['Q1']) == {'Q1': {'id': 'Q1'}}
+    assert not responses
+
+def test_slim_entity():
+    claim = {
+        'id': 'Q1$abc',
+        'type': 'statement',
+        'rank': 'normal',
+        'mainsnak': {
+            'snaktype': 'value',
+            'property': 'P31',
+            'hash': 'abc',
+            'datatype': 'wikibase-item',
+            'datavalue': {'value': {'id': 'Q5'}, 'type': 'wikibase-entityid'},
+        },
+        'qualifiers': {'P580': []},
+        'references': [{'snaks': {}}],
+    }
+    entity = {
+        'id': 'Q1',
+        'lastrevid': 10,
+        'labels': {'en': {'language': 'en', 'value': 'test'}},
+        'descriptions': {'en': {'language': 'en', 'value': 'a test'}},
+        'sitelinks': {'enwiki': {'site': 'enwiki', 'title': 'Test', 'badges': []}},
+        'claims': {'P31': [claim]},
+    }
+    slim = wikidata.slim_entity(entity)
+    assert set(slim) == {'id', 'lastrevid', 'labels', 'sitelinks', 'claims'}
+    assert slim['sitelinks']['enwiki'] == {'site': 'enwiki', 'title': 'Test'}
+    assert slim['claims']['P31'] == [{
+        'rank': 'normal',
+        'mainsnak': {
+            'snaktype': 'value',
+            'property': 'P31',
+            'datavalue': {'value': {'id': 'Q5'}, 'type': 'wikibase-entityid'},
+        },
+    }]
+    assert wikidata.slim_entity(slim) == slim
+    assert wikidata.slim_entity(None) is None
+
+def test_run_queries(monkeypatch):
+    def mock_run_query(query):
+        if query == 'fail':
+            raise wikidata.QueryTimeout(query, None)
+        return [query]
+
+    monkeypatch.setattr(wikidata, 'run_query', mock_run_query)
+    results = wikidata.run_queries({'a': 'one', 'b': 'fail', 'c': 'two'})
+    assert list(results) == ['a', 'b', 'c']
+    assert results['a'] == ['one'] and results['c'] == ['two']
+    assert isinstance(results['b'], wikidata.QueryTimeout)
+
+def test_run_query_retry_after(monkeypatch):
+    class Response:
+        def __init__(self, status_code, headers=None):
+            self.status_code = status_code
+            self.headers = headers or {}
+
+        def json(self):
+            return {'results': {'bindings': ['row']}}
+
+    responses = [Response(429, {'Retry-After': '7'}), Response(200)]
+    delays = []
+
+    monkeypatch.setattr(wikidata.requests, 'post',
+                        lambda url, data, timeout, headers: responses.pop(0))
+    monkeypatch.setattr(wikidata.time, 'sleep', delays.append)
+    assert wikidata.run_query('query') == ['row']
+    assert delays == [7]